@@ -3,26 +3,51 @@ from importlib import import_module
 import logging
 import numpy as np
 from tqdm import tqdm
-from vtk import vtkProbeFilter
 
 from ramos import io
 from ramos.reduction import Reduction
-from ramos.utils.vtk import write_to_file
-from ramos.utils.parallel import parmap
-from ramos.utils.parallel.workers import mv_dot, vv_dot
+from ramos.utils.cache import DiskCache
+from ramos.utils.vtk import Prober, probe_to_file
+from ramos.utils.parallel import parimap
 
 
 @click.group()
 @click.option('--verbosity', '-v',
               type=click.Choice(['debug', 'info', 'warning', 'error', 'critical']),
               default='info')
-def main(verbosity):
+@click.option('--mass-cache/--no-mass-cache', default=True,
+              help='Cache mass matrices on disk')
+@click.option('--patch-cache/--no-patch-cache', default=False,
+              help='Store parsed IFEM patches in a file next to the input')
+def main(verbosity, mass_cache, patch_cache):
     logging.basicConfig(
         format='{asctime} {levelname: <10} {message}',
         datefmt='%H:%M',
         style='{',
         level=verbosity.upper(),
     )
+    if mass_cache:
+        io.DataSource.mass_cache = DiskCache()
+    if patch_cache and io.has_ifem:
+        io.IFEMFileSource.patch_cache = True
+
+
+def make_sink(source, out, compression, compression_level, chunk_size, update_output):
+    """Create a sink for a source, with options that only apply to HDF5 output."""
+    options = {
+        'compression': compression,
+        'compression_opts': compression_level,
+        'chunks': chunk_size,
+        'update': update_output or None,
+    }
+    options = {key: value for key, value in options.items() if value is not None}
+    if compression_level is not None and compression != 'gzip':
+        raise click.UsageError('--compression-level requires --compression gzip')
+    if any(key not in source.sink_options for key in options):
+        raise click.UsageError('HDF5 output options are not supported for {}'.format(
+            source.__class__.__name__
+        ))
+    return source.sink(out, **options)
 
 
 @main.command()
@@ -37,42 +62,86 @@ def summary(data):
 @click.option('--error', '-e', type=float, default=0.05, help='Relative error threshold to achieve')
 @click.option('--out', '-o', type=str, default='out', help='Name of output')
 @click.option('--min-modes', type=int, default=10, help='Minimum number of modes to write')
+@click.option('--jobs', '-j', type=int, default=None, help='Number of worker processes')
+@click.option('--scratch', type=click.Path(file_okay=False), default=None,
+              help='Directory for temporary snapshot storage')
+@click.option('--solver', type=click.Choice(['eigh', 'lanczos', 'randomized']), default='eigh',
+              help='Eigensolver to use')
+@click.option('--method', type=click.Choice(['auto', 'snapshots', 'svd']), default='auto',
+              help='Method of snapshots or direct SVD')
+@click.option('--incremental', type=click.Path(dir_okay=False), default=None,
+              help='Update the decomposition stored in this file with new snapshots')
+@click.option('--compression', type=click.Choice(['gzip', 'lzf']), default=None,
+              help='Compression for HDF5 output')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None,
+              help='Compression level for HDF5 output (requires gzip compression)')
+@click.option('--chunk-size', type=click.IntRange(1), default=None,
+              help='Chunk size for HDF5 output (with or without compression)')
+@click.option('--update-output/--replace-output', default=False,
+              help='Update existing HDF5 output in place, removing anything not written')
 @click.argument('sources', type=io.DataSourceType(), nargs=-1)
-def reduce(fields, error, out, min_modes, sources):
+def reduce(fields, error, out, min_modes, jobs, scratch, solver, method, incremental,
+           compression, compression_level, chunk_size, update_output, sources):
     """Calculate a reduced basis."""
-    sink = sources[0].sink(out)
-    r = Reduction(sources, fields, sink, out, min_modes, error)
-    r.reduce()
+    sink = make_sink(sources[0], out, compression, compression_level, chunk_size, update_output)
+    r = Reduction(
+        sources, fields, sink, out, min_modes, error,
+        ncpus=jobs, scratch=scratch, solver=solver, method=method,
+    )
+    if incremental:
+        r.update(incremental)
+    else:
+        r.reduce()
 
 
 @main.command()
 @click.option('--target', '-t', type=io.DataSourceType(), help='Basis to project onto')
 @click.option('--out', '-o', type=str, default='out', help='Name of output')
+@click.option('--compression', type=click.Choice(['gzip', 'lzf']), default=None,
+              help='Compression for HDF5 output')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None,
+              help='Compression level for HDF5 output (requires gzip compression)')
+@click.option('--chunk-size', type=click.IntRange(1), default=None,
+              help='Chunk size for HDF5 output (with or without compression)')
+@click.option('--update-output/--replace-output', default=False,
+              help='Update existing HDF5 output in place, removing anything not written')
+@click.option('--block-bytes', type=click.IntRange(1), default=2**26,
+              help='Approximate size in bytes of the blocks of time levels projected at once')
 @click.argument('source', type=io.DataSourceType())
-def project(source, target, out):
+def project(source, target, out, compression, compression_level, chunk_size, update_output,
+            block_bytes):
     """Project a data source onto a basis."""
     fields = [f.name for f in target.fields()]
-    mass = target.mass_matrix(fields)
-    sink = source.sink(out)
+    mass = target.mass_operator(fields)
+    sink = make_sink(source, out, compression, compression_level, chunk_size, update_output)
 
-    modes = [target.coefficients(fields, li) for li in target.levels()]
+    # One mode per row, and the mass-weighted modes, so that the projection
+    # coefficients of a snapshot are given by a single product
+    modes = np.array([target.coefficients(fields, li) for li in target.levels()])
+    weighted = mass.dot(modes.T).T
 
-    # Project each time level individually
-    for li in tqdm(source.levels(), desc='Time steps', total=source.ntimes):
-        vector = source.coefficients(fields, li)
-        coeffs = [mass.dot(mode).dot(vector) for mode in modes]
-        recons = np.zeros(vector.shape)
-        for coeff, mode in zip(coeffs, modes):
-            recons += coeff * mode
-        sink.add_level(li)
-        sink.write_fields(li, recons, fields)
+    # Project and reconstruct blocks of time levels at a time
+    levels = list(source.levels())
+    size = max(1, block_bytes // (modes.shape[1] * modes.dtype.itemsize))
+    with sink, tqdm(desc='Time steps', total=len(levels)) as progress:
+        for start in range(0, len(levels), size):
+            block = levels[start:start+size]
+            vectors = np.array([source.coefficients(fields, li) for li in block])
+            recons = vectors.dot(weighted.T).dot(modes)
+            for li, vector in zip(block, recons):
+                sink.add_level(li)
+                sink.write_fields(li, vector, fields)
+            progress.update(len(block))
 
 
 @main.command()
 @click.option('--target', '-t', type=io.DataSourceType(), help='Source from which the mesh will be taken')
 @click.option('--out', '-o', type=str, default='out', help='Name of output')
+@click.option('--jobs', '-j', type=int, default=1, help='Number of worker processes')
+@click.option('--reuse-weights/--no-reuse-weights', default=False,
+              help='Reuse interpolation weights for datasets with the same mesh')
 @click.argument('source', type=io.DataSourceType())
-def interpolate(source, target, out):
+def interpolate(source, target, out, jobs, reuse_weights):
     """Interpolate a data source on a common mesh."""
     if not target:
         target = source
@@ -80,25 +149,32 @@ def interpolate(source, target, out):
     # Interpolation only works on VTK type sources currently
     assert isinstance(source, (io.VTKFilesSource, io.VTKTimeDirsSource))
     assert isinstance(target, (io.VTKFilesSource, io.VTKTimeDirsSource))
-    sink = source.sink(out)
-    for i in source.levels():
-        sink.add_level(i)
-
-    probefilter = vtkProbeFilter()
-    _, dataset = next(target.datasets())
-    probefilter.SetInputData(dataset)
-    # Depending on the source type, a dataset may or may not correspond to a
-    # time level. However, the data sets make up all the information in a
-    # source, so dealing with all of them will create a complete copy.
-    for ind, ds in tqdm(source.datasets()):
-        probefilter.SetSourceData(ds)
-        probefilter.Update()
-        output = probefilter.GetUnstructuredGridOutput()
-        if not output:
-            output = probefilter.GetPolyDataOutput()
-        if not output:
-            raise TypeError('Unsupported dataset type')
-        write_to_file(output, sink.filename(*ind))
+    prober = Prober(target, reuse_weights=reuse_weights)
+
+    # Compute the interpolation weights for the first mesh up front, so that
+    # they are sent to the workers rather than computed by each of them
+    if reuse_weights:
+        prober.weights(source.dataset(*next(source.dataset_indices())))
+
+    with source.sink(out) as sink:
+        for i in source.levels():
+            sink.add_level(i)
+
+        # Depending on the source type, a dataset may or may not correspond to a
+        # time level. However, the data sets make up all the information in a
+        # source, so dealing with all of them will create a complete copy. The
+        # datasets are independent, so they can be read, interpolated and
+        # written by different processes.
+        args = [(index, sink.filename(*index)) for index in source.dataset_indices()]
+        if jobs == 1:
+            for index, filename in tqdm(args):
+                probe_to_file(index, filename, source, prober)
+        else:
+            results = parimap(
+                probe_to_file, args, (source, prober), ncpus=jobs, progress='Interpolating'
+            )
+            for _ in results:
+                pass
 
 
 @main.command()
@@ -1,13 +1,21 @@
 from abc import abstractmethod
 from copy import copy
 import numpy as np
+from scipy.sparse import csr_matrix
 
-from ramos.utils.matrix import MatrixBuilder
+from ramos.utils.matrix import MatrixBuilder, MassOperator, scalar_matrix
+from ramos.utils.vectors import allocate, field_slices
 
 
 __all__ = ['DataSource']
 
 
+# Version of the mass matrix assembly, which is part of the keys of the
+# persistent mass matrix cache. Increase this whenever the computed matrices
+# change (e.g. the quadrature), so that stale matrices are not reused.
+MASS_CACHE_VERSION = 1
+
+
 class Field:
 
     def __init__(self, name, ncomps, size, **kwargs):
@@ -22,6 +30,13 @@ class DataSource:
     defines the minimal interface necessary for a new data source to work.
     """
 
+    # Persistent cache for mass matrices, shared by all data sources (see
+    # ramos.utils.cache.DiskCache). Disabled if None.
+    mass_cache = None
+
+    # Names of the keyword arguments accepted by sink(), beyond the path
+    sink_options = ()
+
     def __init__(self, pardim, ntimes):
         """Initialize a data source with a given number of parametric dimensions
         and time levels.
@@ -43,6 +58,20 @@ class DataSource:
             c._mass = {}
         return c
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, backtrace):
+        self.close()
+
+    def close(self):
+        """Release any resources (such as open files) held by this data source.
+        The source may still be used afterwards, and will then reacquire them.
+
+        Child classes may override this.
+        """
+        pass
+
     def add_field(self, name, *args, **kwargs):
         """add_field(name, ncomps, size, **kwargs)
 
@@ -62,35 +91,85 @@ class DataSource:
         """Iterate over all time levels (by index, not by actual time)."""
         yield from range(0, self.ntimes)
 
-    def mass_matrix(self, fields, single=False):
-        """Compute the mass matrix for the given field(s). `fields` must be a single
-        field, a list of fields, or a list of (field, scale), where `scale` is
-        an optional scaling factor.
+    def mass_blocks(self, fields, single=False):
+        """Return a list of tuples (matrix, ncomps, scale) with the scalar mass
+        matrix, the number of components and the scaling factor of each of
+        the given field(s). See mass_matrix for the arguments.
         """
         if isinstance(fields, str):
             fields = [fields]
 
-        builder = MatrixBuilder()
+        blocks = []
         for name in fields:
             if isinstance(name, tuple):
                 name, scale = name
             else:
                 scale = 1.0
             field = self.field(name)
+            ncomps = 1 if single else field.ncomps
+            blocks.append((self.scalar_mass_matrix(field), ncomps, scale))
+        return blocks
 
-            # Check in the cache if this mass matrix has been computed before.
-            # If not, compute it.
-            if name not in self._mass:
-                self._mass[name] = self.field_mass_matrix(field)
+    def mass_matrix(self, fields, single=False):
+        """Compute the mass matrix for the given field(s). `fields` must be a single
+        field, a list of fields, or a list of (field, scale), where `scale` is
+        an optional scaling factor.
+        """
+        # Only the scalar mass matrix of each field is computed, and the
+        # builder expands it to all the components.
+        builder = MatrixBuilder()
+        for mx, ncomps, scale in self.mass_blocks(fields, single):
+            builder.add_matrix(mx, ncomps, scale)
+        return builder.build()
 
-            # The cache contains the arguments that the matrix builder needs
-            # to construct the matrix (see MatrixBuilder for more info)
-            args = list(self._mass[name])
-            args.append(1 if single else field.ncomps)
-            args.append(scale)
-            builder.add(*args)
+    def mass_operator(self, fields, single=False):
+        """Return the mass matrix for the given field(s) as a MassOperator,
+        which stores only the scalar mass matrix of each field. The arguments
+        are as for mass_matrix.
+        """
+        return MassOperator(*zip(*self.mass_blocks(fields, single)))
 
-        return builder.build()
+    def scalar_mass_matrix(self, field):
+        """Return the scalar mass matrix for a single field, in CSR form (with
+        one row and column per point, regardless of the number of
+        components).
+
+        Matrices are cached in memory, and on disk if a persistent cache is
+        enabled (see mass_cache). In the persistent cache, the matrices are
+        keyed by the mesh hash of the field (see mesh_hash) and by
+        MASS_CACHE_VERSION.
+        """
+        # Check in the cache if this mass matrix has been computed before.
+        # If not, compute it.
+        if field.name in self._mass:
+            return self._mass[field.name]
+
+        def factory():
+            mx = scalar_matrix(*self.field_mass_matrix(field), size=field.size)
+            return {'data': mx.data, 'indices': mx.indices, 'indptr': mx.indptr}
+
+        key = self.mesh_hash(field) if self.mass_cache is not None else None
+        if key is None:
+            arrays = factory()
+        else:
+            key = 'mass-v{}-{}'.format(MASS_CACHE_VERSION, key)
+            arrays = self.mass_cache.get(key, factory)
+
+        mx = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(field.size, field.size),
+        )
+        self._mass[field.name] = mx
+        return mx
+
+    def mesh_hash(self, field):
+        """Return a string that uniquely identifies the discretization of a
+        field, for the purpose of caching mass matrices, or None if this is
+        not supported.
+
+        Child classes may override this.
+        """
+        return None
 
     def unity_coefficients(self, fields, field, comp=0):
         """Return the unity coefficient vector for a field/component.
@@ -107,13 +186,14 @@ class DataSource:
             coeffs.append(array)
         return np.hstack(coeffs)
 
-    def coefficients(self, fields, level=0, flatten=True):
+    def coefficients(self, fields, level=0, flatten=True, out=None):
         """Return the coefficient vector for one or more fields at a given time level.
 
         `fields` must be a field name or a list of fields. If `flatten` is
         false, a matrix of shape npts × ncomps is returned, otherwise the
         result is flattened to one dimension. (For multiple fields, `flatten`
-        must be true.)
+        must be true.) For a list of fields, `out` may optionally be given as
+        the array to write the result into.
         """
         if isinstance(fields, str):
             field = self.field(fields)
@@ -123,10 +203,21 @@ class DataSource:
             return np.reshape(coeffs, (field.size, field.ncomps))
         if not flatten:
             raise ValueError
-        return np.hstack([
-            np.ndarray.flatten(self.field_coefficients(self.field(name), level))
-            for name in fields
-        ])
+        return self.fields_coefficients([self.field(name) for name in fields], level, out)
+
+    def fields_coefficients(self, fields, level=0, out=None):
+        """Return the concatenated coefficient vector for a list of fields at a given
+        time level.
+
+        If `out` is given, the coefficients are written directly into it, and
+        it is returned. Otherwise, a new vector is allocated.
+
+        Child classes may override this to read all the fields in one go.
+        """
+        out = allocate(fields, out)
+        for field, sl in field_slices(fields):
+            out[sl] = np.ndarray.flatten(self.field_coefficients(field, level))
+        return out
 
     @abstractmethod
     def field_mass_matrix(self, field):
@@ -1,14 +1,18 @@
 import h5py
+import hashlib
 from io import StringIO
-from itertools import chain, product, repeat
+from itertools import repeat
 from lxml import etree
+import logging
 import numpy as np
-from os.path import splitext
+import os
+from os.path import abspath, splitext
+import splipy
 import splipy.io
 
 from ramos.io.Base import DataSource, DataSink
 from ramos.utils.splipy import mass_matrix
-from ramos.utils.vectors import decompose
+from ramos.utils.vectors import allocate, decompose, field_slices
 
 
 class G2Object(splipy.io.G2):
@@ -22,28 +26,94 @@ class G2Object(splipy.io.G2):
         return self
 
 
+def parse_patch(blob):
+    """Parse a single patch from raw G2 data."""
+    with G2Object(StringIO(blob.decode()), 'r') as g:
+        return g.read()[0]
+
+
+# The arrays describing a patch (see patch_to_arrays)
+PATCH_ARRAYS = ('knots', 'lengths', 'orders', 'periodic', 'controlpoints', 'rational')
+
+
+def patch_to_arrays(patch):
+    """Convert a patch to a dictionary of plain arrays, which can be stored
+    without pickling. The knot vectors of all directions are concatenated in
+    'knots', with their lengths in 'lengths'.
+    """
+    knots = [basis.knots for basis in patch.bases]
+    return {
+        'knots': np.hstack(knots),
+        'lengths': np.array([len(k) for k in knots], dtype=int),
+        'orders': np.array([basis.order for basis in patch.bases], dtype=int),
+        'periodic': np.array([basis.periodic for basis in patch.bases], dtype=int),
+        'controlpoints': np.asarray(patch.controlpoints),
+        'rational': np.array(patch.rational, dtype=bool),
+    }
+
+
+def arrays_to_patch(knots, lengths, orders, periodic, controlpoints, rational):
+    """Reconstruct a patch from the arrays returned by patch_to_arrays."""
+    bounds = np.cumsum(lengths)[:-1]
+    bases = [
+        splipy.BSplineBasis(int(order), kts, int(per))
+        for kts, order, per in zip(np.split(knots, bounds), orders, periodic)
+    ]
+    cls = {1: splipy.Curve, 2: splipy.Surface, 3: splipy.Volume}[len(bases)]
+    return cls(*bases, controlpoints, bool(rational), raw=True)
+
+
 def obj_to_string(obj):
     s = StringIO()
-    with IFEMFile.G2Object(s, 'w') as f:
+    with G2Object(s, 'w') as f:
         f.write(obj)
-    return s.getvalue()
+        return s.getvalue()
 
 
-class IFEMFileSource(DataSource):
+# Open HDF5 files, mapping file names to tuples (pid, file). Files are opened
+# at most once per process, and shared by all sources reading from them, also
+# when sources are unpickled anew for every task in a worker process.
+_hdf5_files = {}
+
 
-    def __init__(self, filename):
-        self.hdf_filename = filename
+class IFEMFileSource(DataSource):
 
+    # Whether to store parsed patches in a sidecar file by default
+    patch_cache = False
+
+    sink_options = ('compression', 'compression_opts', 'chunks', 'update')
+
+    def __init__(self, filename, patch_cache=None):
+        """Create a source reading from an IFEM HDF5 file (and the XML file
+        with the same base name).
+
+        If `patch_cache` is true, parsed patches are stored in a sidecar file
+        next to the HDF5 file, so that they don't have to be parsed again the
+        next time the file is read. By default, this is decided by the class
+        attribute of the same name.
+        """
+        if patch_cache is None:
+            patch_cache = self.patch_cache
+        self.hdf_filename = abspath(filename)
+        self._patches = {}      # Map (basis, index) to parsed patches
+        self._stored = {}       # Map (basis, index) to (digest, patch) from the sidecar
+        self._stored_changed = False
+        self.cache_filename = splitext(filename)[0] + '.patches' if patch_cache else None
+        if self.cache_filename:
+            self.load_patch_cache()
+
+        # The XML tree is only needed here, and is not kept as an attribute, so
+        # that the source can be pickled and sent to worker processes.
         xml_filename = splitext(filename)[0] + '.xml'
-        self.xml = etree.parse(xml_filename)
+        xml = etree.parse(xml_filename)
 
         bases = []
-        with self.hdf5() as f:
-            basis = next(iter(f['0/basis']))
-            bases.append(basis)
-            patch = self.patch(basis, 0)
-            pardim = patch.pardim
-            ntimes = len(f)
+        f = self.hdf5()
+        basis = next(iter(f['0/basis']))
+        bases.append(basis)
+        patch = self.patch(basis, 0)
+        pardim = patch.pardim
+        ntimes = len(f)
 
         variates = repeat(False)
         for basis in bases:
@@ -58,26 +128,115 @@ class IFEMFileSource(DataSource):
         super(IFEMFileSource, self).__init__(pardim, ntimes)
         self.variates = [i for i, v in enumerate(variates) if v]
 
-        for xmlf in self.xml.findall("./entry[@type='field']"):
+        for xmlf in xml.findall("./entry[@type='field']"):
             name = xmlf.attrib['name']
             ncomps = int(xmlf.attrib['components'])
             basis = xmlf.attrib['basis']
             size = sum(len(p) for p in self.patches(basis))
             self.add_field(name, ncomps, size, basis=basis)
 
+        # All the patches in use have been parsed by now
+        if self._stored_changed:
+            self.save_patch_cache()
+
+    def __getstate__(self):
+        # The parsed patches are all in self._patches by now, so there is no
+        # need to send the sidecar contents to worker processes
+        state = self.__dict__.copy()
+        state['_stored'] = {}
+        return state
+
     def hdf5(self):
-        return h5py.File(self.hdf_filename, 'r')
+        """Return the HDF5 file. It is opened once per process, and kept open
+        until the source is closed, so callers must not close it.
+        """
+        # A handle inherited from a parent process through fork is not safe
+        # to use, so each process opens its own
+        pid = os.getpid()
+        entry = _hdf5_files.get(self.hdf_filename)
+        if entry is None or entry[0] != pid:
+            entry = (pid, h5py.File(self.hdf_filename, 'r'))
+            _hdf5_files[self.hdf_filename] = entry
+        return entry[1]
+
+    def close(self):
+        """Close the HDF5 file, if it was opened by this process."""
+        entry = _hdf5_files.pop(self.hdf_filename, None)
+        if entry is not None and entry[0] == os.getpid():
+            entry[1].close()
 
     def npatches(self, basis):
-        with self.hdf5() as f:
-            return len(f['0/basis/{}'.format(basis)])
+        return len(self.hdf5()['0/basis/{}'.format(basis)])
 
     def patch(self, basis, index):
-        with self.hdf5() as f:
-            g2str = f['0/basis/{}/{}'.format(basis, index+1)][:].tobytes().decode()
-            g2data = StringIO(g2str)
-            with G2Object(g2data, 'r') as g:
-                return g.read()[0]
+        """Return a single patch of a basis.
+
+        Patches are parsed once and cached, so the returned object is shared
+        and must not be modified (clone it first).
+        """
+        key = (basis, index)
+        if key in self._patches:
+            return self._patches[key]
+
+        blob = self.hdf5()['0/basis/{}/{}'.format(basis, index+1)][:].tobytes()
+        if self.cache_filename:
+            # A patch stored in the sidecar is only valid if the raw G2 data
+            # is unchanged
+            digest = hashlib.sha1(blob).hexdigest()
+            if key in self._stored and self._stored[key][0] == digest:
+                patch = self._stored[key][1]
+            else:
+                patch = parse_patch(blob)
+                self._stored[key] = (digest, patch)
+                self._stored_changed = True
+        else:
+            patch = parse_patch(blob)
+
+        self._patches[key] = patch
+        return patch
+
+    def load_patch_cache(self):
+        """Load parsed patches from the sidecar file, if it exists.
+
+        The sidecar holds only plain arrays (see save_patch_cache), so that
+        loading it never executes code.
+        """
+        try:
+            with np.load(self.cache_filename, allow_pickle=False) as f:
+                keys = zip(f['bases'], f['indices'], f['digests'])
+                for i, (basis, index, digest) in enumerate(keys):
+                    arrays = {name: f['{}.{}'.format(name, i)] for name in PATCH_ARRAYS}
+                    patch = arrays_to_patch(**arrays)
+                    self._stored[(str(basis), int(index))] = (str(digest), patch)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning('Ignoring unreadable patch cache %s: %s', self.cache_filename, e)
+            self._stored = {}
+
+    def save_patch_cache(self):
+        """Write parsed patches to the sidecar file, as an .npz file with the
+        arrays 'bases', 'indices' and 'digests' identifying each patch, and
+        the arrays '<name>.<i>' describing patch number i (see
+        patch_to_arrays).
+        """
+        keys = sorted(self._stored)
+        arrays = {
+            'bases': np.array([basis for basis, _ in keys]),
+            'indices': np.array([index for _, index in keys], dtype=int),
+            'digests': np.array([self._stored[key][0] for key in keys]),
+        }
+        for i, key in enumerate(keys):
+            for name, array in patch_to_arrays(self._stored[key][1]).items():
+                arrays['{}.{}'.format(name, i)] = array
+
+        tmp = self.cache_filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, self.cache_filename)
+        except OSError as e:
+            logging.warning('Unable to write patch cache %s: %s', self.cache_filename, e)
 
     def patches(self, basis):
         for i in range(self.npatches(basis)):
@@ -91,18 +250,37 @@ class IFEMFileSource(DataSource):
             ret.append(mass_matrix(patch, glob_index))
             glob_index += len(patch)
 
-        return tuple(
-            np.array(list(chain.from_iterable(r[i] for r in ret)))
-            for i in range(3)
-        )
+        return tuple(np.hstack([r[i] for r in ret]) for i in range(3))
+
+    def mesh_hash(self, field):
+        """Return a hash of the patches of a field, for caching mass matrices."""
+        h = hashlib.sha1()
+        group = self.hdf5()['0/basis/{}'.format(field.basis)]
+        for i in range(len(group)):
+            h.update(group[str(i+1)][:].tobytes())
+        return h.hexdigest()
 
     def field_coefficients(self, field, level=0):
         npatches = self.npatches(field.basis)
-        with self.hdf5() as f:
-            return np.hstack([
-                f['{}/{}/{}'.format(level, pid+1, field.name)][:]
-                for pid in range(npatches)
-            ])
+        f = self.hdf5()
+        return np.hstack([
+            f['{}/{}/{}'.format(level, pid+1, field.name)][:]
+            for pid in range(npatches)
+        ])
+
+    def fields_coefficients(self, fields, level=0, out=None):
+        """Return the concatenated coefficient vector for a list of fields at a given
+        time level, reading the datasets directly into the output vector.
+        """
+        out = allocate(fields, out)
+        grp = self.hdf5()[str(level)]
+        for field, sl in field_slices(fields):
+            index = sl.start
+            for pid in range(self.npatches(field.basis)):
+                dataset = grp['{}/{}'.format(pid+1, field.name)]
+                dataset.read_direct(out, dest_sel=np.s_[index:index+dataset.size])
+                index += dataset.size
+        return out
 
     def tesselate(self, field, level=0):
         field = self.field(field)
@@ -111,6 +289,7 @@ class IFEMFileSource(DataSource):
         xs, ys, zs = [], [], []
         glob_index = 0
         for i, patch in enumerate(self.patches(field.basis)):
+            patch = patch.clone()
             params = patch.knots()
             pts = patch(*params)
             xs.append(np.ndarray.flatten(pts[..., self.variates[0]]))
@@ -134,19 +313,68 @@ class IFEMFileSource(DataSource):
         return IFEMFileSink(self, *args, **kwargs)
 
 
+def matches_layout(dataset, data, options):
+    """Check whether an existing HDF5 dataset can hold `data` when created with
+    the given options (see IFEMFileSink.dataset_options).
+    """
+    if dataset.shape != data.shape or dataset.dtype != data.dtype:
+        return False
+    if dataset.compression != options.get('compression'):
+        return False
+    opts = options.get('compression_opts')
+    if opts is not None and dataset.compression_opts != opts:
+        return False
+    chunks = options.get('chunks')
+    if chunks is None or chunks is True:
+        return (dataset.chunks is None) == (chunks is None)
+    return dataset.chunks == chunks
+
+
 class IFEMFileSink(DataSink):
 
-    def __init__(self, parent, path):
+    def __init__(self, parent, path, compression=None, compression_opts=None, chunks=None,
+                 update=False):
+        """Create a sink writing to an IFEM HDF5 file (and an XML file with the
+        same base name).
+
+        - `compression`: Compression filter for field datasets ('gzip' or
+          'lzf'), or None
+        - `compression_opts`: The compression level, for gzip only
+        - `chunks`: Chunk size (number of values) for field datasets, with or
+          without compression. By default, datasets are contiguous, unless
+          compressed, in which case h5py picks a chunk size.
+        - `update`: If true, an existing file is updated rather than replaced.
+          Datasets that already exist with the same layout are overwritten in
+          place, datasets with a different layout (e.g. another compression
+          or chunk size) are recreated, and anything that is not written
+          (levels, fields, patches) is removed.
+        """
+        # Invalid combinations are rejected here, before the file is opened
+        # (and possibly truncated), rather than by h5py when writing
+        if compression not in (None, 'gzip', 'lzf'):
+            raise ValueError('Unsupported compression filter: {}'.format(compression))
+        if compression_opts is not None and compression != 'gzip':
+            raise ValueError('Compression options are only supported for gzip compression')
+
         self.parent = parent
         self.hdf5_filename = path
         basename, _ = splitext(path)
-        self.xml_filename = '{}.xml'.format(path)
+        self.xml_filename = '{}.xml'.format(basename)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunks = chunks
+        self.update = update
 
     def __enter__(self):
-        self.hdf5 = h5py.File(self.hdf5_filename, 'w')
+        self.hdf5 = h5py.File(self.hdf5_filename, 'a' if self.update else 'w')
         self.dom = etree.Element('info')
+        self.levels = set()
+        self.written = set()    # Full names of the datasets written
+        return self
 
     def __exit__(self, type_, value, backtrace):
+        if self.update and type_ is None:
+            self.remove_stale()
         self.hdf5.close()
         with open(self.xml_filename, 'wb') as f:
             f.write(etree.tostring(
@@ -154,33 +382,92 @@ class IFEMFileSink(DataSink):
                 xml_declaration=True, standalone=True,
             ))
 
+    def remove_stale(self):
+        """Remove everything from an updated file that was not written in this
+        session: datasets (e.g. fields, patches or bases no longer present),
+        and the groups left empty, except for the levels that were added.
+        """
+        stale = []
+        self.hdf5.visititems(
+            lambda name, obj: stale.append(name)
+            if isinstance(obj, h5py.Dataset) and '/' + name not in self.written else None
+        )
+        for name in stale:
+            del self.hdf5[name]
+
+        groups = []
+        self.hdf5.visititems(
+            lambda name, obj: groups.append(name) if isinstance(obj, h5py.Group) else None
+        )
+        keep = {str(level) for level in self.levels}
+        for name in sorted(groups, key=lambda name: -name.count('/')):
+            if len(self.hdf5[name]) == 0 and name not in keep:
+                del self.hdf5[name]
+
     def add_level(self, time):
-        index = len(self.hdf5)
-        self.hdf5.require_group(str(index))
+        self.hdf5.require_group(str(time))
+        self.levels.add(time)
 
     def ensure_basis(self, basis):
-        grp = self.hdf5.require_group('0/basis')
-        if basis in grp:
-            return
-        grp = grp.require_group(basis)
+        grp = self.hdf5.require_group('0/basis').require_group(basis)
         for i, patch in enumerate(self.parent.patches(basis)):
-            ints = np.fromstring(obj_to_string(patch), dtype=np.int8)
-            pid = str(i + 1)
-            if pid in grp:
-                del grp[pid]
-            grp.create_dataset(pid, data=ints, dtype=np.int8)
+            self.write_dataset(
+                grp, str(i + 1), np.frombuffer(obj_to_string(patch).encode(), dtype=np.int8),
+                compress=False,
+            )
+
+    def ensure_field(self, field):
+        """Add an entry for a field to the XML file, if necessary."""
+        if self.dom.find("./entry[@name='{}']".format(field.name)) is not None:
+            return
+        self.ensure_basis(field.basis)
+        etree.SubElement(self.dom, 'entry', {
+            'name': field.name,
+            'description': 'primary',
+            'type': 'field',
+            'basis': field.basis,
+            'patches': str(self.parent.npatches(field.basis)),
+            'components': str(field.ncomps),
+        })
+
+    def dataset_options(self, data, compress=True):
+        """Return the keyword arguments for creating a dataset for `data`."""
+        if not compress:
+            return {}
+        chunks = (min(self.chunks, len(data)),) if self.chunks and len(data) > 0 else None
+        if self.compression is None and chunks is None:
+            return {}
+        return {
+            'chunks': chunks or True,
+            'compression': self.compression,
+            'compression_opts': self.compression_opts,
+        }
+
+    def write_dataset(self, grp, name, data, compress=True):
+        """Write a dataset, overwriting an existing one in place if it has the
+        same layout (size, type, chunking and compression). Otherwise, it is
+        created anew.
+        """
+        options = self.dataset_options(data, compress)
+        self.written.add('{}/{}'.format(grp.name, name))
+        if name in grp:
+            dataset = grp[name]
+            if matches_layout(dataset, data, options):
+                dataset[...] = data
+                return
+            del grp[name]
+        grp.create_dataset(name, data=data, **options)
 
     def write_fields(self, level, coeffs, fields):
         fields = [self.parent.field(f) for f in fields]
         field_coeffs = decompose(fields, coeffs)
 
         for field, coeffs in zip(fields, field_coeffs):
-            self.ensure_basis(field.basis)
+            self.ensure_field(field)
+            coeffs = np.ravel(coeffs)
             glob_index = 0
             for i, patch in enumerate(self.parent.patches(field.basis)):
                 grp = self.hdf5.require_group('{}/{}'.format(level, i+1))
-                if field.name in grp:
-                    del grp[field.name]
                 n = len(patch) * field.ncomps
-                grp.create_dataset(field.name, data=coeffs[glob_index:glob_index+n])
+                self.write_dataset(grp, field.name, coeffs[glob_index:glob_index+n])
                 glob_index += n
@@ -1,18 +1,21 @@
 from os import makedirs
 import numpy as np
 from os.path import exists, isdir, join, split
-from vtk import vtkDataSetReader
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 from ramos.io.Base import DataSource, DataSink
+from ramos.utils.cache import LRUCache
 from ramos.utils.mesh import mesh_filter
-from ramos.utils.vectors import decompose
-from ramos.utils.vtk import mass_matrix, write_to_file, get_cell_indices
+from ramos.utils.vectors import allocate, decompose, field_slices
+from ramos.utils.vtk import (
+    mass_matrix, mesh_hash, write_to_file, get_cell_indices, read_dataset, dataset_size,
+    shallow_copy,
+)
 
 
 class VTKFilesSource(DataSource):
 
-    def __init__(self, files):
+    def __init__(self, files, cache_count=4, cache_bytes=None):
         """VTKFilesSource reads this type of structure:
 
         <basename>-0.vtk
@@ -20,8 +23,12 @@ class VTKFilesSource(DataSource):
         <basename>-2.vtk
         ...
         <basename>-n.vtk
+
+        Parsed datasets are kept in a cache bounded by `cache_count` datasets
+        and/or `cache_bytes` bytes.
         """
         self.files = files
+        self._datasets = LRUCache(cache_count, cache_bytes, dataset_size)
 
         # Try to figure out how many parametric dimensions this data has.
         # Do this by loading any dataset and inspecting its bounding box.
@@ -50,16 +57,27 @@ class VTKFilesSource(DataSource):
             size = pointdata.GetAbstractArray(i).GetNumberOfTuples()
             self.add_field(name, ncomps, size)
 
-    def datasets():
-        """Iterate over all datasets in this source."""
-        return ((i, self.dataset(i)) for i in range(len(self.files)))
+    def dataset_indices(self):
+        """Iterate over the indices of all datasets in this source, as tuples
+        (file_index,).
+        """
+        return ((i,) for i in range(len(self.files)))
+
+    def datasets(self):
+        """Iterate over all datasets in this source, as tuples (index, dataset)."""
+        return ((index, self.dataset(*index)) for index in self.dataset_indices())
+
+    def filename(self, index):
+        """Return the file name of a given file index."""
+        return self.files[index]
 
     def dataset(self, index):
-        """Return a single dataset associated with a file index."""
-        reader = vtkDataSetReader()
-        reader.SetFileName(self.files[index])
-        reader.Update()
-        return reader.GetOutput()
+        """Return a single dataset associated with a file index.
+
+        The dataset may be shared with other callers, so it must not be
+        modified.
+        """
+        return self._datasets.get(index, lambda: read_dataset(self.filename(index)))
 
     def field_mass_matrix(self, field):
         """Return the mass matrix for a single field."""
@@ -67,12 +85,29 @@ class VTKFilesSource(DataSource):
         # See ramos.utils.vtk.mass_matrix for more info
         return mass_matrix(self.dataset(0), self.variates)
 
+    def mesh_hash(self, field):
+        """Return a hash of the mesh of a field, for caching mass matrices."""
+        return mesh_hash(self.dataset(0), self.variates)
+
     def field_coefficients(self, field, level=0):
         """Return the coefficient vector for a single field at a given time level."""
         dataset = self.dataset(level)
         pointdata = dataset.GetPointData()
         array = pointdata.GetAbstractArray(field.name)
-        return vtk_to_numpy(array)
+
+        # The dataset is shared through the cache, so return a copy that
+        # callers are free to modify
+        return vtk_to_numpy(array).copy()
+
+    def fields_coefficients(self, fields, level=0, out=None):
+        """Return the concatenated coefficient vector for a list of fields at a given
+        time level, reading all of them from the same dataset.
+        """
+        out = allocate(fields, out)
+        pointdata = self.dataset(level).GetPointData()
+        for field, sl in field_slices(fields):
+            out[sl] = np.ndarray.flatten(vtk_to_numpy(pointdata.GetAbstractArray(field.name)))
+        return out
 
     def tesselate(self, field, variates=None, level=0, condition=None):
         """Return a tesselation (for plotting) of a single field at a given time level.
@@ -129,11 +164,14 @@ class VTKFilesSink(DataSink):
     def add_level(self, time):
         self.files.append('{}-{}.vtk'.format(join(self.path, self.basename), len(self.files)))
 
+    def filename(self, index):
+        return self.files[index]
+
     def write_fields(self, level, coeffs, fields):
         fields = [self.parent.field(f) for f in fields]
         field_coeffs = decompose(fields, coeffs)
 
-        dataset = self.parent.dataset(level)
+        dataset = shallow_copy(self.parent.dataset(level))
         pointdata = dataset.GetPointData()
         while pointdata.GetNumberOfArrays() > 0:
             pointdata.RemoveArray(0)
@@ -2,18 +2,21 @@ from itertools import groupby
 import numpy as np
 from os import listdir, makedirs
 from os.path import exists, isdir, join
-import vtk
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 from ramos.io.Base import DataSource, DataSink
+from ramos.utils.cache import LRUCache
 from ramos.utils.mesh import mesh_filter
 from ramos.utils.vectors import decompose
-from ramos.utils.vtk import mass_matrix, write_to_file, get_cell_indices
+from ramos.utils.vtk import (
+    mass_matrix, mesh_hash, write_to_file, get_cell_indices, read_dataset, dataset_size,
+    shallow_copy,
+)
 
 
 class VTKTimeDirsSource(DataSource):
 
-    def __init__(self, paths):
+    def __init__(self, paths, cache_count=None, cache_bytes=None):
         """VTKTimeDirsSource reads this type of structure:
 
         <time1>/<file1>.vtk
@@ -29,6 +32,10 @@ class VTKTimeDirsSource(DataSource):
         the directory names must be valid floating point numbers.
 
         `paths` is a list of pathnames to consider.
+
+        Parsed datasets are kept in a cache bounded by `cache_count` datasets
+        (by default, the number of files in a time directory) and/or
+        `cache_bytes` bytes.
         """
         self.paths = paths
 
@@ -38,6 +45,10 @@ class VTKTimeDirsSource(DataSource):
             files = files & set(listdir(path))
         self.files = list(files)
 
+        if cache_count is None:
+            cache_count = max(len(self.files), 1)
+        self._datasets = LRUCache(cache_count, cache_bytes, dataset_size)
+
         # Try to figure out how many parametric dimensions this data has.
         # Do this by loading any dataset and inspecting its bounding box.
         # (Not foolproof.)
@@ -67,24 +78,30 @@ class VTKTimeDirsSource(DataSource):
                 size = pointdata.GetAbstractArray(i).GetNumberOfTuples()
                 self.add_field(name, ncomps, size, file_index=fi)
 
+    def dataset_indices(self):
+        """Iterate over the indices of all datasets in this source, as tuples
+        (path_index, file_index).
+        """
+        return ((i,j) for i in range(len(self.paths)) for j in range(len(self.files)))
+
     def datasets(self):
-        """Iterate over all datasets in this source."""
-        return (
-            ((i,j), self.dataset(i,j))
-            for i in range(len(self.paths))
-            for j in range(len(self.files))
-        )
+        """Iterate over all datasets in this source, as tuples (index, dataset)."""
+        return ((index, self.dataset(*index)) for index in self.dataset_indices())
 
     def filename(self, path_index, file_index):
         """Return the full file name of a given path and file index."""
         return join(self.paths[path_index], self.files[file_index])
 
     def dataset(self, path_index, file_index):
-        """Return a single dataset associated with a path and file index."""
-        reader = vtk.vtkDataSetReader()
-        reader.SetFileName(self.filename(path_index, file_index))
-        reader.Update()
-        return reader.GetOutput()
+        """Return a single dataset associated with a path and file index.
+
+        The dataset may be shared with other callers, so it must not be
+        modified.
+        """
+        return self._datasets.get(
+            (path_index, file_index),
+            lambda: read_dataset(self.filename(path_index, file_index)),
+        )
 
     def field_mass_matrix(self, field):
         """Return the mass matrix for a single field."""
@@ -92,12 +109,19 @@ class VTKTimeDirsSource(DataSource):
         # See ramos.utils.vtk.mass_matrix for more info
         return mass_matrix(self.dataset(0, field.file_index), self.variates)
 
+    def mesh_hash(self, field):
+        """Return a hash of the mesh of a field, for caching mass matrices."""
+        return mesh_hash(self.dataset(0, field.file_index), self.variates)
+
     def field_coefficients(self, field, level=0):
         """Return the coefficient vector for a single field at a given time level."""
         dataset = self.dataset(level, field.file_index)
         pointdata = dataset.GetPointData()
         array = pointdata.GetAbstractArray(field.name)
-        return vtk_to_numpy(array)
+
+        # The dataset is shared through the cache, so return a copy that
+        # callers are free to modify
+        return vtk_to_numpy(array).copy()
 
     def tesselate(self, field, variates=None, level=0, condition=None):
         """Return a tesselation (for plotting) of a single field at a given time level.
@@ -164,7 +188,7 @@ class VTKTimeDirsSink(DataSink):
         key = lambda d: d[0].file_index
         data = sorted(data, key=key)
         for file_index, field_data in groupby(data, key):
-            dataset = self.parent.dataset(0, file_index)
+            dataset = shallow_copy(self.parent.dataset(0, file_index))
             pointdata = dataset.GetPointData()
             while pointdata.GetNumberOfArrays() > 0:
                 pointdata.RemoveArray(0)
@@ -130,6 +130,11 @@ class DataSourceType(click.ParamType):
 
     def convert(self, value, param, ctx):
         try:
-            return load(value)
+            source = load(value)
         except FileNotFoundError:
             self.fail('{} is not a valid data location'.format(value), param, ctx)
+
+        # Release open files when the command finishes
+        if ctx is not None:
+            ctx.call_on_close(source.close)
+        return source
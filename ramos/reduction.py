@@ -1,14 +1,21 @@
 from itertools import combinations_with_replacement
 import logging
+from math import ceil, sqrt
 import numpy as np
+import os
+from scipy.linalg import cholesky, LinAlgError
 
-from ramos.utils.parallel import parmap
-from ramos.utils.parallel.workers import energy_content, normalized_coeffs, mv_dot, vv_dot
+from ramos.utils.eigen import SOLVERS
+from ramos.utils.parallel import parmap, parimap, Pool
+from ramos.utils.parallel.workers import energy_content, stored_mm_dot, gram_tile
+from ramos.utils.store import SnapshotStore
 
 
 class Reduction:
 
-    def __init__(self, sources, fields, sink, output, min_modes=10, error=0.05):
+    def __init__(self, sources, fields, sink, output, min_modes=10, error=0.05, ncpus=None,
+                 scratch=None, block_bytes=2**26, solver='eigh', method='auto',
+                 svd_bytes=2**30):
         """Create a reduced basis using POD.
 
         - `sources`: The data sources to use as input
@@ -17,6 +24,19 @@ class Reduction:
         - `output`: Name of the csv file to write spectral information to
         - `min_modes`: Minimum number of modes to write
         - `error`: Error threshold to achieve
+        - `ncpus`: Number of worker processes to use (by default, the number
+          of CPUs)
+        - `scratch`: Directory in which to store snapshots temporarily (by
+          default, the system temporary directory)
+        - `block_bytes`: Approximate size of the blocks of snapshots that
+          are processed at a time
+        - `solver`: Eigensolver to use for the covariance matrix (see
+          ramos.utils.eigen)
+        - `method`: Either 'snapshots' (the method of snapshots), 'svd' (direct
+          SVD of the mass-weighted snapshot matrix) or 'auto' (choose the
+          cheapest)
+        - `svd_bytes`: Maximal amount of memory to use for a direct SVD. This
+          applies also if the SVD is explicitly requested.
         """
         self.sources = sources
         self.fields = fields
@@ -24,6 +44,12 @@ class Reduction:
         self.output = output
         self.min_modes = min_modes
         self.error = error
+        self.ncpus = ncpus
+        self.scratch = scratch
+        self.block_bytes = block_bytes
+        self.solver = solver
+        self.method = method
+        self.svd_bytes = svd_bytes
 
         # Create a master source that will be used to compute mass matrices.
         # Other sources will be passed to worker processes, so we want to keep
@@ -43,87 +69,357 @@ class Reduction:
             self._nsnaps = len(self.source_levels())
         return self._nsnaps
 
+    @property
+    def ndofs(self):
+        """Size of the coefficient vector of a snapshot."""
+        return sum(self.master.field(f).size * self.master.field(f).ncomps for f in self.fields)
+
     @property
     def nfields(self):
         """Number of fields under consideration."""
         return len(self.fields)
 
+    def blocks(self, store, pool):
+        """Split the snapshots in a store into blocks of consecutive indices, for
+        tiled computations. Returns a list of (start, stop) tuples.
+
+        The blocks are bounded in size by `block_bytes`, but small enough that
+        there are at least as many upper triangular tiles as workers.
+        """
+        nworkers = len(pool.workers)
+        nblocks = ceil((sqrt(8 * nworkers + 1) - 1) / 2)
+        size = min(store.block_size(self.block_bytes), ceil(store.nsnaps / nblocks))
+        return [(start, min(start + size, store.nsnaps)) for start in range(0, store.nsnaps, size)]
+
     def reduce(self):
         """Compute a reduced basis using POD."""
 
+        # Compute the grand unified mass matrix that applies to the grand
+        # unified coefficient vectors (with multiple fields).
+        logging.info('Computing master mass matrix')
+        mass = self.master.mass_operator(self.fields)
+
+        # Choose the method that is expected to be the cheapest, before
+        # allocating any of the resources that only one of them needs
+        method, factor = self.choose_method(mass)
+
+        # The snapshots are kept on disk, and shared with the workers through
+        # memory maps.
+        with SnapshotStore(self.nsnaps, self.ndofs, self.scratch) as ensemble:
+            if method == 'svd':
+                self.read_snapshots(ensemble)
+                eigvals, eigvecs, scale = self.svd_eigenpairs(ensemble, factor)
+            else:
+                # All the parallel work is dispatched on the same set of
+                # worker processes, which live for the duration of the
+                # eigenvalue computation. The products of the snapshots with
+                # the mass matrix are kept on disk as well.
+                with Pool(self.ncpus) as pool, \
+                     SnapshotStore(self.nsnaps, self.ndofs, self.scratch) as ensemble_m:
+                    self.read_snapshots(ensemble, pool)
+                    eigvals, eigvecs, scale = self.snapshot_eigenpairs(
+                        pool, ensemble, ensemble_m, mass
+                    )
+
+            # Write modes to sink
+            nmodes = self.count_modes(eigvals, scale)
+            logging.info('Writing %d modes', nmodes)
+            with self.sink as sink:
+                for start, modes in self.modes(ensemble, eigvals[:nmodes], eigvecs[:,:nmodes]):
+                    for i, mode in enumerate(modes, start=start):
+                        sink.add_level(i)
+                        sink.write_fields(i, mode, self.fields)
+
+        self.write_spectrum(eigvals, scale)
+
+    def read_snapshots(self, ensemble, pool=None):
+        """Read the coefficients of all snapshots into a store, optionally
+        using a worker pool for the preparatory computations.
+        """
         # If there are multiple fields, we must compute the weight for each of
         # them, so that they have equal energy contribution.
-        self.compute_scales()
+        self.compute_scales(pool)
 
-        # Compute the coefficients for each snapshot.
+        # Read the coefficients for each snapshot directly into the store.
         logging.info('Normalizing ensemble')
-        ensemble = [source.coefficients(self.fields, li) for source, li in self.source_levels()]
+        for i, (source, li) in enumerate(self.source_levels()):
+            source.coefficients(self.fields, li, out=ensemble[i])
+        ensemble.flush()
 
-        # Compute the grand unified mass matrix that applies to the grand
-        # unified coefficient vectors (with multiple fields). This should be
-        # quick since it uses cached data.
-        logging.info('Computing master mass matrix')
-        mass = self.master.mass_matrix(self.fields)
+    def choose_method(self, mass):
+        """Choose between the method of snapshots and a direct SVD of the
+        mass-weighted snapshot matrix, based on rough estimates of their
+        costs. `mass` is the mass operator (see ramos.utils.matrix). Returns
+        the name of the method, and for the SVD, a factor of the mass matrix
+        (see mass_factor).
+        """
+        nsnaps, ndofs, nnz = self.nsnaps, self.ndofs, mass.nnz
+        diagonal = all(is_diagonal(mx) for mx in mass.matrices)
+
+        # Rough flop counts. The method of snapshots requires products with
+        # the mass matrix, the covariance matrix and its eigendecomposition.
+        # The SVD requires scaling (or multiplying by a dense factor of) the
+        # snapshot matrix, and the SVD itself.
+        costs = {
+            'snapshots': 2 * nnz * nsnaps + nsnaps ** 2 * ndofs + 4 * nsnaps ** 3,
+            'svd': 4 * nsnaps * ndofs * min(nsnaps, ndofs) + (
+                nsnaps * ndofs if diagonal else ndofs ** 3 / 3 + nsnaps * ndofs ** 2
+            ),
+        }
+
+        # The method of snapshots runs on all the worker processes
+        costs['snapshots'] /= self.ncpus or os.cpu_count() or 1
+
+        # The SVD works on the whole snapshot matrix in memory
+        nbytes = 8 * nsnaps * ndofs + (0 if diagonal else 8 * ndofs ** 2)
+
+        method = self.method
+        if method == 'auto':
+            if nbytes > self.svd_bytes:
+                method, reason = 'snapshots', 'snapshot matrix too large for direct SVD'
+            elif costs['svd'] < costs['snapshots']:
+                method, reason = 'svd', 'estimated cost {:.2e} vs {:.2e} flops'.format(
+                    costs['svd'], costs['snapshots']
+                )
+            else:
+                method, reason = 'snapshots', 'estimated cost {:.2e} vs {:.2e} flops'.format(
+                    costs['snapshots'], costs['svd']
+                )
+        elif method == 'svd' and nbytes > self.svd_bytes:
+            # Never attempt an SVD that would exhaust the memory, even if
+            # requested
+            logging.warning(
+                'Direct SVD would require %d MB (limit %d MB), using the method of snapshots',
+                nbytes // 2**20, self.svd_bytes // 2**20
+            )
+            method, reason = 'snapshots', 'snapshot matrix too large for direct SVD'
+        else:
+            reason = 'requested'
 
-        # Compute all the matrix-vector products.
+        factor = None
+        if method == 'svd':
+            factor = mass_factor(mass.tocsr())
+            if factor is None:
+                method, reason = 'snapshots', 'mass matrix is not positive definite'
+
+        logging.info(
+            'Using %s (%s; %d snapshots, %d dofs, %d nonzeros in mass matrix)',
+            'direct SVD' if method == 'svd' else 'method of snapshots',
+            reason, nsnaps, ndofs, nnz
+        )
+        return method, factor
+
+    def snapshot_eigenpairs(self, pool, ensemble, ensemble_m, mass):
+        """Compute the leading eigenpairs of the covariance matrix using the
+        method of snapshots, i.e. by assembling and decomposing it.
+        """
+        # Compute all the matrix-vector products, one block of snapshots at a
+        # time. Only the file names of the stores are sent to the workers,
+        # which read from and write to them directly.
         logging.info('Computing matrix-vector products')
-        ensemble_m = parmap(mv_dot, ensemble, (mass,), unwrap=False)
+        blocks = self.blocks(ensemble, pool)
+        args = (ensemble, ensemble_m, mass)
+        parmap(stored_mm_dot, blocks, args, unwrap=False, pool=pool, chunksize=1)
 
         # Compute the actual covariance matrix, made up of terms of the type
-        # u^T × M × v, where u and v are coefficient vectors. To do this, we
-        # calculate dot-products of all pairs of vectors in ensemble and
-        # ensemble_m.
+        # u^T × M × v, where u and v are coefficient vectors. This is the
+        # product of the snapshot matrix with the transpose of the matrix of
+        # matrix-vector products, which we compute one tile at a time. Only
+        # the upper triangular tiles are necessary, due to symmetry.
         logging.info('Computing covariance matrix')
-        args = [
-            (a, b) for (a, _), (_, b) in
-            combinations_with_replacement(zip(ensemble, ensemble_m), 2)
-        ]
-        corrs = parmap(vv_dot, args)
+        args = list(combinations_with_replacement(blocks, 2))
         corrmx = np.empty((self.nsnaps, self.nsnaps))
-        i, j = np.triu_indices(self.nsnaps)
-        corrmx[i, j] = corrs
-        corrmx[j, i] = corrs
-        del corrs               # Let GC deal with this one
-
-        # Compute the eigenvalue decomposition of the covariance matrix,
-        # ordered from high to low eigenvalues.
-        logging.info('Computing eigenvalue decomposition')
-        eigvals, eigvecs = np.linalg.eigh(corrmx)
-        scale = sum(eigvals)
-        eigvals = eigvals[::-1]
-        eigvecs = eigvecs[:,::-1]
+        tiles = parimap(gram_tile, args, (ensemble, ensemble_m), pool=pool)
+        for (i, j), (k, l), tile in tiles:
+            corrmx[i:j, k:l] = tile
+            corrmx[k:l, i:j] = tile.T
+
+        logging.info('Computing eigenvalue decomposition (%s)', self.solver)
+        return self.eigenpairs(corrmx)
+
+    def svd_eigenpairs(self, ensemble, factor):
+        """Compute the leading eigenpairs of the covariance matrix from the
+        SVD of the mass-weighted snapshot matrix, without assembling it.
+
+        The eigenvalues are the squared singular values, and the
+        eigenvectors are the left singular vectors.
+        """
+        logging.info('Computing singular value decomposition')
+        snapshots = np.array(ensemble[:])
+        if factor.ndim == 1:
+            snapshots *= factor
+        else:
+            snapshots = snapshots.dot(factor)
+        eigvecs, values, _ = np.linalg.svd(snapshots, full_matrices=False)
+        eigvals = values ** 2
+        return eigvals, eigvecs, np.sum(eigvals)
+
+    def modes(self, ensemble, eigvals, eigvecs):
+        """Compute the modes from the snapshots and the eigenpairs of the
+        covariance matrix. The modes are linear combinations of the snapshots,
+        computed as matrix products, one block of modes at a time, and
+        accumulated over blocks of snapshots from the store.
+
+        Yields tuples (start, modes), where `modes` is a block of modes (one
+        per row) starting at index `start`.
+        """
+        nmodes = len(eigvals)
+        size = ensemble.block_size(self.block_bytes)
+        for start in range(0, nmodes, size):
+            stop = min(start + size, nmodes)
+            modes = np.zeros((stop - start, self.ndofs))
+            for i, block in ensemble.blocks(size):
+                modes += eigvecs[i:i+len(block), start:stop].T.dot(block)
+            modes /= np.sqrt(eigvals[start:stop])[:,np.newaxis]
+            yield start, modes
+
+    def update(self, state_file):
+        """Compute or update a reduced basis incrementally, using POD.
+
+        The state of the decomposition (a truncated mass-weighted SVD of the
+        snapshot matrix) is read from `state_file`, if it exists. Only the
+        levels that are not already accounted for in the state are read from
+        the sources, one block at a time. The modes are then written to the
+        sink, and the updated state is written back to `state_file`.
+
+        Note that the sources must be given in the same order as when the
+        state was created, and that new levels are assumed to be appended.
+        """
+        mass = self.master.mass_operator(self.fields)
+        modes, values, scale, nlevels = self.load_state(state_file)
+
+        new = [
+            (source, level)
+            for source, n in zip(self.sources, nlevels)
+            for level in list(source.levels())[n:]
+        ]
+        logging.info('Updating decomposition with %d new snapshots', len(new))
 
+        # Singular directions are dropped as long as the accumulated error
+        # stays well below the error threshold, so that the state stays
+        # reasonably small.
+        tol = self.error / 10
+        size = max(1, self.block_bytes // (self.ndofs * 8))
+        for start in range(0, len(new), size):
+            block = new[start:start+size]
+            snapshots = np.empty((len(block), self.ndofs))
+            for row, (source, li) in zip(snapshots, block):
+                source.coefficients(self.fields, li, out=row)
+            modes, values, energy = svd_update(
+                modes, values, snapshots.T, mass, tol, self.min_modes, scale
+            )
+            scale += energy
+            logging.debug('Rank after %d snapshots: %d', start + len(block), len(values))
+
+        if len(values) == 0:
+            raise ValueError('No snapshots available')
+
+        nlevels = [len(list(source.levels())) for source in self.sources]
+        self.save_state(state_file, modes, values, scale, nlevels)
+
+        # The squared singular values are the eigenvalues of the covariance
+        # matrix, and the left singular vectors are the (normalized) modes.
+        eigvals = values ** 2
+        nmodes = self.count_modes(eigvals, scale)
+        logging.info('Writing %d modes', nmodes)
+        with self.sink as sink:
+            for i in range(nmodes):
+                sink.add_level(i)
+                sink.write_fields(i, modes[:,i], self.fields)
+
+        self.write_spectrum(eigvals, scale)
+
+    def load_state(self, state_file):
+        """Load the state of an incremental decomposition. Returns the modes
+        (one per column), the singular values, the total energy of all
+        snapshots seen so far and the number of levels read from each source.
+
+        If the file does not exist, an empty state is returned.
+        """
+        if not os.path.exists(state_file):
+            return np.zeros((self.ndofs, 0)), np.zeros((0,)), 0.0, [0] * len(self.sources)
+
+        logging.info('Reading state from %s', state_file)
+        with np.load(state_file) as state:
+            if list(state['fields']) != list(self.fields):
+                raise ValueError('State was created with fields {}'.format(', '.join(state['fields'])))
+            if state['modes'].shape[0] != self.ndofs:
+                raise ValueError('State was created with {} degrees of freedom, expected {}'.format(
+                    state['modes'].shape[0], self.ndofs
+                ))
+            nlevels = list(state['levels'])
+            if len(nlevels) > len(self.sources):
+                raise ValueError('State was created with {} sources'.format(len(nlevels)))
+            nlevels += [0] * (len(self.sources) - len(nlevels))
+            return state['modes'], state['values'], float(state['energy']), nlevels
+
+    def save_state(self, state_file, modes, values, energy, nlevels):
+        """Save the state of an incremental decomposition (see load_state)."""
+        # Write to a temporary file first, so that an interrupted write can't
+        # destroy the existing state
+        tmp = state_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, modes=modes, values=values, energy=energy,
+                levels=np.array(nlevels, dtype=int), fields=np.array(self.fields),
+            )
+        os.replace(tmp, state_file)
+
+    def count_modes(self, eigvals, scale):
+        """Compute the number of modes to write, given the leading eigenvalues
+        of the covariance matrix in descending order and the sum of all of
+        them. Logs the error achieved.
+        """
         # Compute the number of modes necessary to satisfy the error threshold,
         # and the actual error achieved.
         threshold = (1 - self.error ** 2) * scale
-        nmodes = min(np.where(np.cumsum(eigvals) > threshold)[0]) + 1
-        actual_error = np.sqrt(np.sum(eigvals[nmodes:]) / scale)
+        candidates = np.where(np.cumsum(eigvals) > threshold)[0]
+        nmodes = candidates[0] + 1 if len(candidates) > 0 else len(eigvals)
+        actual_error = np.sqrt(max(scale - np.sum(eigvals[:nmodes]), 0) / scale)
         logging.info(
             '%d modes suffice for %.2f%% error (threshold %.2f%%)',
             nmodes, 100*actual_error, 100*self.error
         )
+        return min(len(eigvals), max(nmodes, self.min_modes))
 
-        # Write modes to sink
-        nmodes = min(len(eigvals), max(nmodes, self.min_modes))
-        logging.info('Writing %d modes', nmodes)
-        with self.sink as sink:
-            for i in range(nmodes):
-                sink.add_level(i)
-                mode = np.zeros(ensemble[0].shape)
-                for j, e in enumerate(ensemble):
-                    mode += eigvecs[j,i] * e
-                mode /= np.sqrt(eigvals[i])
-                sink.write_fields(i, mode, self.fields)
-
-        # Write spectrum to CSV file
+    def write_spectrum(self, eigvals, scale):
+        """Write the spectrum to a CSV file. With a truncated solver, only the
+        leading part of the spectrum is known, but the tail sums can still be
+        computed from the sum of all the eigenvalues.
+        """
         with open(self.output + '.csv', 'w') as f:
             for i, ev in enumerate(eigvals):
-                s = np.sum(eigvals[i+1:]) / scale
+                s = max(scale - np.sum(eigvals[:i+1]), 0) / scale
                 f.write('{} {} {} {}\n'.format(
                     i+1, ev/scale, s, np.sqrt(s)
                 ))
 
-    def compute_scales(self):
+    def eigenpairs(self, corrmx):
+        """Compute the leading eigenpairs of the covariance matrix, at least as
+        many as are needed to satisfy the error threshold and the minimal
+        number of modes.
+
+        Returns the eigenvalues in descending order, the eigenvectors and the
+        sum of all the eigenvalues.
+        """
+        solver = SOLVERS[self.solver]
+
+        # The sum of all the eigenvalues is the trace, so we can tell whether
+        # enough of them have been found without computing the rest.
+        scale = np.trace(corrmx)
+        threshold = (1 - self.error ** 2) * scale
+        k = min(max(self.min_modes, 1), self.nsnaps)
+        while True:
+            eigvals, eigvecs = solver(corrmx, k)
+            if len(eigvals) >= self.nsnaps:
+                break
+            if len(eigvals) >= k and np.sum(eigvals) > threshold:
+                break
+            logging.debug('%d eigenpairs are not enough, retrying', len(eigvals))
+            k = min(2 * k, self.nsnaps)
+        return eigvals, eigvecs, scale
+
+    def compute_scales(self, pool=None):
         """Compute weighing factors for each field."""
 
         # Trivial case: only one field
@@ -137,9 +433,11 @@ class Reduction:
         energies = []
         for field in self.fields:
             logging.debug('Field: %s', field)
-            mass = self.master.mass_matrix([field])
+            mass = self.master.mass_operator([field])
             args = self.source_levels()
-            energy = parmap(energy_content, args, (field, mass), reduction=sum)
+            energy = parmap(
+                energy_content, args, (field, mass), reduction=sum, pool=pool, chunksize=1
+            )
             logging.debug('Energy: %e', energy)
             energies.append(energy)
 
@@ -151,3 +449,87 @@ class Reduction:
             'Scaling factors: %s',
             ', '.join(('{}={}'.format(f, s) for f, s in zip(self.fields, self.scales)))
         )
+
+
+def svd_update(modes, values, snapshots, mass, tol=0.0, min_rank=0, total=None):
+    """Update a truncated SVD of a snapshot matrix with new snapshots, using the
+    inner product induced by a mass matrix (Brand, 2006).
+
+    - `modes`: Matrix whose columns are the current left singular vectors,
+      orthonormal with respect to the mass matrix
+    - `values`: The current singular values, in descending order
+    - `snapshots`: Matrix whose columns are the new snapshots
+    - `mass`: The mass matrix
+    - `tol`: The weakest singular directions are dropped, as long as the
+      total energy dropped over all updates so far stays below tol² times
+      the total energy of all snapshots (the previous ones and the new
+      ones). The relative error of the truncated SVD is then at most `tol`.
+    - `min_rank`: Minimal number of singular directions to keep, if possible
+    - `total`: The total energy of all the previous snapshots. The energy
+      dropped in earlier updates is the difference between this and the
+      energy of the current singular values. By default, nothing is assumed
+      to have been dropped.
+
+    Returns the updated modes and singular values, and the total energy (sum
+    of squared norms) of the new snapshots.
+    """
+    msnaps = mass.dot(snapshots)
+    energy = np.sum(snapshots * msnaps)
+
+    # Split the new snapshots into their components in the span of the
+    # current modes and the residuals.
+    proj = modes.T.dot(msnaps)
+    resid = snapshots - modes.dot(proj)
+
+    # Find an orthonormal basis for the span of the residuals from the
+    # eigenvalue decomposition of their Gram matrix, so that resid = basis ×
+    # rfac. Directions with negligible energy are discarded.
+    lam, vecs = np.linalg.eigh(resid.T.dot(mass.dot(resid)))
+    keep = lam > 1e-12 * (np.sum(values ** 2) + energy)
+    lam, vecs = lam[keep], vecs[:,keep]
+    basis = resid.dot(vecs / np.sqrt(lam))
+    rfac = np.sqrt(lam)[:,np.newaxis] * vecs.T
+
+    # The updated snapshot matrix is [modes, basis] × K × (orthogonal), so its
+    # SVD follows from that of the small matrix K.
+    nvals, nres = len(values), len(lam)
+    kmx = np.zeros((nvals + nres, nvals + snapshots.shape[1]))
+    kmx[:nvals,:nvals] = np.diag(values)
+    kmx[:nvals,nvals:] = proj
+    kmx[nvals:,nvals:] = rfac
+    kvecs, values, _ = np.linalg.svd(kmx, full_matrices=False)
+
+    # Truncate, keeping the least number of directions such that the energy
+    # dropped over all updates is within the bound
+    if total is None:
+        total = np.sum(kmx[:nvals,:nvals] ** 2)
+    dropped = max(total - np.sum(kmx[:nvals,:nvals] ** 2), 0.0)
+    budget = tol ** 2 * (total + energy) - dropped
+    tails = np.append(np.cumsum(values[::-1] ** 2)[::-1], 0.0)
+    rank = np.argmax(tails <= budget) if budget >= 0 else len(values)
+    rank = max(rank, min(min_rank, np.sum(values > 0)))
+    modes = np.hstack([modes, basis]).dot(kvecs[:,:rank])
+    return modes, values[:rank], energy
+
+
+def is_diagonal(mx):
+    """Check whether a sparse matrix is diagonal."""
+    mx = mx.tocoo()
+    return bool(np.all(mx.row[mx.data != 0] == mx.col[mx.data != 0]))
+
+
+def mass_factor(mass):
+    """Compute a factor L of a mass matrix M, so that M = L × L^T. For a
+    diagonal matrix, this is the square root of the diagonal, returned as a
+    vector. Otherwise it is the dense Cholesky factor. Returns None if the
+    matrix is not positive definite.
+    """
+    if is_diagonal(mass):
+        diag = mass.diagonal()
+        if np.any(diag <= 0):
+            return None
+        return np.sqrt(diag)
+    try:
+        return cholesky(mass.toarray(), lower=True)
+    except LinAlgError:
+        return None
@@ -0,0 +1,32 @@
+import numpy as np
+
+from ramos.utils.cache import LRUCache, DiskCache
+
+
+def test_lru_cache():
+    cache = LRUCache(maxcount=2)
+    for key in 'abcb':
+        cache.get(key, lambda: key)
+    assert len(cache) == 2
+    assert 'a' not in cache and 'b' in cache and 'c' in cache
+
+
+def test_disk_cache(tmp_path):
+    calls = []
+    def factory():
+        calls.append(1)
+        return {'x': np.arange(1000, dtype=float)}
+
+    cache = DiskCache(str(tmp_path), maxbytes=10000)
+    assert np.allclose(cache.get('a', factory)['x'], np.arange(1000))
+    assert np.allclose(cache.get('a', factory)['x'], np.arange(1000))
+    assert len(calls) == 1
+
+    # Each entry is about 8 kB, so only the most recent one fits
+    cache.get('b', factory)
+    assert len(cache.entries()) == 1
+    cache.get('a', factory)
+    assert len(calls) == 3
+
+    cache.clear()
+    assert cache.entries() == []
@@ -0,0 +1,14 @@
+import numpy as np
+
+from ramos.utils.eigen import SOLVERS
+
+
+def test_solvers():
+    rng = np.random.RandomState(1)
+    x = rng.standard_normal((40, 8)) * 2.0 ** -np.arange(8)
+    mx = x.dot(x.T)
+    exact = np.linalg.eigvalsh(mx)[::-1]
+    for solver in SOLVERS.values():
+        eigvals, eigvecs = solver(mx, 5)
+        assert np.allclose(eigvals[:5], exact[:5])
+        assert np.allclose(mx.dot(eigvecs[:,:5]), eigvecs[:,:5] * eigvals[:5])
@@ -0,0 +1,132 @@
+from click.testing import CliRunner
+from itertools import product
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+from ramos.__main__ import main
+from ramos.utils.vtk import Prober, read_dataset, write_to_file
+
+
+class Target:
+
+    def __init__(self, dataset):
+        self._dataset = dataset
+
+    def dataset_indices(self):
+        yield (0,)
+
+    def dataset(self, index):
+        return self._dataset
+
+
+def grid(coords, values=None):
+    points = vtk.vtkPoints()
+    for x, y in coords:
+        points.InsertNextPoint(x, y, 0.0)
+    ret = vtk.vtkUnstructuredGrid()
+    ret.SetPoints(points)
+    if values is not None:
+        ret.InsertNextCell(vtk.VTK_QUAD, 4, [0, 1, 4, 3])
+        ret.InsertNextCell(vtk.VTK_TRIANGLE, 3, [1, 2, 5])
+        ret.InsertNextCell(vtk.VTK_TRIANGLE, 3, [1, 5, 4])
+        array = numpy_to_vtk(values, deep=1)
+        array.SetName('u')
+        ret.GetPointData().AddArray(array)
+    return ret
+
+
+def annulus(nr, ntheta, cells=True):
+    """A quarter annulus with radii 1 and 2, with quadrilateral cells."""
+    r, theta = np.meshgrid(np.linspace(1, 2, nr), np.linspace(0, np.pi/2, ntheta), indexing='ij')
+    points = vtk.vtkPoints()
+    for x, y in zip(np.ravel(r * np.cos(theta)), np.ravel(r * np.sin(theta))):
+        points.InsertNextPoint(x, y, 0.0)
+    ret = vtk.vtkUnstructuredGrid()
+    ret.SetPoints(points)
+    if cells:
+        for i, j in product(range(nr - 1), range(ntheta - 1)):
+            k = i * ntheta + j
+            ret.InsertNextCell(vtk.VTK_QUAD, 4, [k, k + ntheta, k + ntheta + 1, k + 1])
+    return ret
+
+
+def add_array(data, name, values):
+    array = numpy_to_vtk(values, deep=1)
+    array.SetName(name)
+    data.AddArray(array)
+
+
+def probe(source, target, reuse_weights):
+    output = Prober(Target(target), reuse_weights=reuse_weights)(source)
+    pointdata = output.GetPointData()
+    return {
+        pointdata.GetArrayName(i): vtk_to_numpy(pointdata.GetArray(i)).copy()
+        for i in range(pointdata.GetNumberOfArrays())
+    }
+
+
+def test_reuse_weights():
+    coords = [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]
+    source = grid(coords, np.arange(6, dtype=float))
+    target = grid([(0.5, 0.5), (1.2, 0.3), (1.7, 0.9), (3.0, 0.0)])
+
+    expected, result = (probe(source, target, reuse) for reuse in (False, True))
+    assert np.allclose(expected['u'], result['u'])
+    assert np.array_equal(expected['vtkValidPointMask'], result['vtkValidPointMask'])
+    assert np.array_equal(result['vtkValidPointMask'], [1, 1, 1, 0])
+
+
+def test_reuse_weights_curved():
+    # The target points on the outer boundary lie slightly outside the
+    # polygonal source mesh, but within the tolerance of the probe filter
+    source = annulus(6, 50)
+    target = annulus(18, 18, cells=False)
+    npts, ncells = source.GetNumberOfPoints(), source.GetNumberOfCells()
+    add_array(source.GetPointData(), 'u', np.random.RandomState(0).standard_normal((npts, 2)))
+    add_array(source.GetPointData(), 'n', np.arange(npts, dtype=np.int32))
+    add_array(source.GetCellData(), 'c', np.arange(ncells, dtype=float))
+
+    expected, result = (probe(source, target, reuse) for reuse in (False, True))
+    assert set(expected) == set(result) == {'u', 'n', 'c', 'vtkValidPointMask'}
+    assert np.all(expected['vtkValidPointMask'] == 1)
+    assert np.array_equal(expected['vtkValidPointMask'], result['vtkValidPointMask'])
+    assert np.allclose(expected['u'], result['u'])
+    for name in ('n', 'c'):
+        assert np.array_equal(expected[name], result[name])
+
+
+def test_interpolate_parallel(tmp_path):
+    rng = np.random.RandomState(0)
+    (tmp_path / 'source').mkdir()
+    for level in range(4):
+        source = annulus(5, 7)
+        add_array(source.GetPointData(), 'u', rng.standard_normal((source.GetNumberOfPoints(),)))
+        write_to_file(source, str(tmp_path / 'source' / 'data-{}.vtk'.format(level)))
+    (tmp_path / 'target').mkdir()
+    write_to_file(annulus(9, 11), str(tmp_path / 'target' / 'mesh-0.vtk'))
+
+    runner = CliRunner()
+    outputs = {}
+    for options in (['-j', '1'], ['-j', '3'], ['-j', '3', '--reuse-weights']):
+        out = str(tmp_path / 'out{}'.format(len(outputs)))
+        result = runner.invoke(main, [
+            '--no-mass-cache', 'interpolate', '-t', str(tmp_path / 'target'), '-o', out,
+            *options, str(tmp_path / 'source'),
+        ])
+        assert result.exit_code == 0, result.output
+        datasets = [read_dataset('{}/mode-{}.vtk'.format(out, level)) for level in range(4)]
+        outputs[' '.join(options)] = [
+            vtk_to_numpy(dataset.GetPointData().GetArray('u')) for dataset in datasets
+        ]
+
+    serial = outputs['-j 1']
+    assert np.array_equal(serial, outputs['-j 3'])
+    assert np.allclose(serial, outputs['-j 3 --reuse-weights'])
+
+    # Each output level is interpolated from the corresponding input level
+    source, target = (
+        read_dataset(str(tmp_path / path)) for path in ('source/data-2.vtk', 'target/mesh-0.vtk')
+    )
+    expected = probe(source, target, False)
+    assert np.allclose(serial[2], expected['u'])
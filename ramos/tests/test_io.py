@@ -0,0 +1,81 @@
+import click
+import pytest
+import vtk
+import numpy as np
+from vtk.util.numpy_support import numpy_to_vtk
+
+from ramos.io import VTKFilesSource
+from ramos.utils.vtk import write_to_file
+
+
+def write_levels(path, nlevels):
+    points = vtk.vtkPoints()
+    for x, y in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        points.InsertNextPoint(x, y, 0.0)
+    filenames = []
+    for level in range(nlevels):
+        grid = vtk.vtkUnstructuredGrid()
+        grid.SetPoints(points)
+        grid.InsertNextCell(vtk.VTK_QUAD, 4, [0, 1, 3, 2])
+        array = numpy_to_vtk(np.arange(8, dtype=float).reshape(4, 2) + level, deep=1)
+        array.SetName('u')
+        grid.GetPointData().AddArray(array)
+        filename = str(path / 'data-{}.vtk'.format(level))
+        write_to_file(grid, filename)
+        filenames.append(filename)
+    return filenames
+
+
+def test_coefficients_not_shared(tmp_path):
+    source = VTKFilesSource(write_levels(tmp_path, 2))
+    expected = np.arange(8, dtype=float).reshape(4, 2) + 1
+
+    coeffs = source.coefficients('u', 1, flatten=False)
+    assert np.array_equal(coeffs, expected)
+    coeffs -= np.mean(coeffs, axis=0)
+    coeffs = source.coefficients('u', 1)
+    coeffs[:] = 0.0
+
+    assert np.array_equal(source.coefficients('u', 1, flatten=False), expected)
+    assert np.array_equal(source.coefficients(['u'], 1), expected.flatten())
+
+
+def test_patch_arrays():
+    from splipy import surface_factory
+    from ramos.io.IFEMFile import patch_to_arrays, arrays_to_patch
+
+    patch = surface_factory.disc(type='square')
+    patch.raise_order(1, 0)
+    patch.refine(2, 1)
+    arrays = patch_to_arrays(patch)
+    assert all(array.dtype != object for array in arrays.values())
+
+    copy = arrays_to_patch(**arrays)
+    assert copy.order() == patch.order() and copy.rational == patch.rational
+    assert all(np.array_equal(a, b) for a, b in zip(copy.knots(), patch.knots()))
+    assert np.array_equal(copy.controlpoints, patch.controlpoints)
+
+
+def test_sink_options(tmp_path):
+    from ramos.__main__ import make_sink
+    from ramos.io.IFEMFile import IFEMFileSink
+
+    # Invalid combinations must be rejected before the output is touched
+    path = tmp_path / 'out.hdf5'
+    for options in [{'compression': 'lzf', 'compression_opts': 4}, {'compression_opts': 4}]:
+        with pytest.raises(ValueError):
+            IFEMFileSink(None, str(path), **options)
+    assert not path.exists()
+
+    source = VTKFilesSource(write_levels(tmp_path, 1))
+    for compression in ['lzf', None]:
+        with pytest.raises(click.UsageError, match='--compression-level'):
+            make_sink(source, str(path), compression, 4, None, False)
+    with pytest.raises(click.UsageError, match='not supported'):
+        make_sink(source, str(path), 'gzip', None, None, False)
+
+    # A chunk size applies also without compression
+    sink = IFEMFileSink(None, str(path), chunks=10)
+    assert sink.dataset_options(np.zeros(100)) == {
+        'chunks': (10,), 'compression': None, 'compression_opts': None,
+    }
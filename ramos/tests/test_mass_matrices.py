@@ -1,3 +1,4 @@
+from itertools import product
 import vtk
 import numpy as np
 
@@ -83,3 +84,69 @@ def test_vtk_triangles():
             [0, 1/24, 1/24, 1/12],
         ])
     )
+
+
+def test_vtk_hexahedron():
+    points = vtk.vtkPoints()
+    for z, y, x in product(range(2), repeat=3):
+        points.InsertNextPoint(x, y, z)
+    grid = vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    grid.InsertNextCell(vtk.VTK_HEXAHEDRON, 8, [0, 1, 3, 2, 4, 5, 7, 6])
+    builder = MatrixBuilder()
+    data, rows, cols = mass_matrix(grid, [0, 1, 2])
+    builder.add(data, rows, cols, 1)
+    line = np.array([[1/3, 1/6], [1/6, 1/3]])
+    assert np.allclose(builder.build().toarray(), np.kron(np.kron(line, line), line))
+
+
+def test_vtk_tetrahedron():
+    points = vtk.vtkPoints()
+    points.InsertNextPoint(0.0, 0.0, 0.0)
+    points.InsertNextPoint(2.0, 0.0, 0.0)
+    points.InsertNextPoint(0.0, 1.0, 0.0)
+    points.InsertNextPoint(0.0, 0.0, 1.0)
+    grid = vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    grid.InsertNextCell(vtk.VTK_TETRA, 4, [0, 1, 2, 3])
+    builder = MatrixBuilder()
+    data, rows, cols = mass_matrix(grid, [0, 1, 2])
+    builder.add(data, rows, cols, 1)
+    assert np.allclose(builder.build().toarray(), (np.ones((4, 4)) + np.eye(4)) / 60)
+
+
+def test_vtk_vectorized_mixed():
+    points = vtk.vtkPoints()
+    points.InsertNextPoint(0.0, 0.0, 0.0)
+    points.InsertNextPoint(1.2, 0.1, 0.0)
+    points.InsertNextPoint(0.1, 0.9, 0.0)
+    points.InsertNextPoint(1.0, 1.3, 0.0)
+    points.InsertNextPoint(2.1, 0.5, 0.0)
+    grid = vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    grid.InsertNextCell(vtk.VTK_QUAD, 4, [0, 2, 3, 1])
+    grid.InsertNextCell(vtk.VTK_TRIANGLE, 3, [1, 3, 4])
+    results = []
+    for vectorized in (True, False):
+        builder = MatrixBuilder()
+        data, rows, cols = mass_matrix(grid, [0, 1], parallel=False, vectorized=vectorized)
+        builder.add(data, rows, cols, 1)
+        results.append(builder.build().toarray())
+    assert np.allclose(*results)
+
+
+def test_splipy_tensor():
+    from splipy import surface_factory
+    from ramos.utils.splipy import mass_matrix as spline_mass_matrix
+
+    patch = surface_factory.square().set_order(3, 2)
+    patch.refine(2, 1)
+    patch.controlpoints[..., 1] *= 1 + patch.controlpoints[..., 0] / 2
+    results = []
+    for vectorized in (True, False):
+        builder = MatrixBuilder()
+        data, rows, cols = spline_mass_matrix(patch, 0, parallel=False, vectorized=vectorized)
+        builder.add(data, rows, cols, 1, size=len(patch))
+        results.append(builder.build().toarray())
+    assert np.allclose(*results)
+    assert np.isclose(np.sum(results[0]), 1.25)
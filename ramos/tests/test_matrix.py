@@ -0,0 +1,35 @@
+import numpy as np
+from scipy.sparse import block_diag, identity, kron, random
+
+from ramos.utils.matrix import MatrixBuilder, MassOperator
+
+
+def test_matrix_builder():
+    a = random(6, 6, density=0.4, format='coo', random_state=0)
+    b = random(4, 4, density=0.5, format='coo', random_state=1)
+
+    builder = MatrixBuilder()
+    builder.add(a.data, a.row, a.col, ncomps=3, size=6)
+    builder.add_matrix(b.tocsr(), ncomps=2, scale=2.0)
+    mx = builder.build()
+
+    expected = block_diag([kron(a, identity(3)), 2 * kron(b, identity(2))])
+    assert mx.shape == (26, 26)
+    assert np.allclose(mx.toarray(), expected.toarray())
+
+
+def test_mass_operator():
+    a = random(6, 6, density=0.4, format='csr', random_state=0)
+    b = random(4, 4, density=0.5, format='csr', random_state=1)
+    op = MassOperator([a, b], [3, 2], [1.0, 2.0])
+
+    builder = MatrixBuilder()
+    builder.add_matrix(a, 3)
+    builder.add_matrix(b, 2, 2.0)
+    mx = builder.build()
+
+    x = np.random.RandomState(2).standard_normal((26, 5))
+    assert op.shape == mx.shape and op.nnz == mx.nnz
+    assert np.allclose(op.dot(x), mx.dot(x))
+    assert np.allclose(op.dot(x[:,0]), mx.dot(x[:,0]))
+    assert np.allclose(op.tocsr().toarray(), mx.toarray())
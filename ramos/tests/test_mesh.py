@@ -0,0 +1,59 @@
+import vtk
+import numpy as np
+
+from ramos.utils.mesh import mesh_filter
+from ramos.utils.vtk import get_cell_arrays, get_cell_indices, split_legacy_cells
+
+
+def mixed_grid():
+    points = vtk.vtkPoints()
+    for x, y in [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]:
+        points.InsertNextPoint(x, y, 0.0)
+    grid = vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    grid.InsertNextCell(vtk.VTK_QUAD, 4, [0, 1, 4, 3])
+    grid.InsertNextCell(vtk.VTK_TRIANGLE, 3, [1, 2, 5])
+    grid.InsertNextCell(vtk.VTK_TRIANGLE, 3, [1, 5, 4])
+    return grid
+
+
+def test_cell_indices():
+    cell_indices, offsets, connectivity = get_cell_indices(mixed_grid(), compact=True)
+    assert np.array_equal(cell_indices, [[0, 1, 4, 3], [1, 2, 5, -1], [1, 5, 4, -1]])
+    assert np.array_equal(offsets, [0, 4, 7, 10])
+    assert np.array_equal(connectivity, [0, 1, 4, 3, 1, 2, 5, 1, 5, 4])
+
+
+def test_legacy_cells():
+    offsets, connectivity = get_cell_arrays(mixed_grid())
+    legacy = [4, 0, 1, 4, 3, 3, 1, 2, 5, 3, 1, 5, 4]
+    result = split_legacy_cells(legacy, 3)
+    assert np.array_equal(result[0], offsets)
+    assert np.array_equal(result[1], connectivity)
+
+    rng = np.random.RandomState(0)
+    sizes = rng.randint(3, 9, size=1000)
+    connectivity = rng.randint(0, 100, size=np.sum(sizes))
+    offsets = np.append(0, np.cumsum(sizes))
+    legacy = np.hstack([
+        np.append(n, connectivity[i:i+n]) for i, n in zip(offsets, sizes)
+    ])
+    result = split_legacy_cells(legacy, len(sizes))
+    assert np.array_equal(result[0], offsets)
+    assert np.array_equal(result[1], connectivity)
+
+    result = split_legacy_cells(np.tile([3, 0, 1, 2], 5), 5)
+    assert np.array_equal(result[0], np.arange(0, 16, 3))
+
+
+def test_mesh_filter():
+    x, y = np.arange(6.0), -np.arange(6.0)
+    cell_indices = get_cell_indices(mixed_grid())
+
+    fx, fy, tris = mesh_filter(x, y, cell_indices)
+    assert np.array_equal(fx, x) and np.array_equal(fy, y)
+    assert np.array_equal(tris, [[0, 1, 4], [1, 4, 3], [1, 2, 5], [1, 5, 4]])
+
+    fx, fy, tris = mesh_filter(x, y, cell_indices, np.array([1, 2, 4, 5]))
+    assert np.array_equal(fx, x[[1, 2, 4, 5]])
+    assert np.array_equal(tris, [[0, 1, 3], [0, 3, 2]])
@@ -0,0 +1,63 @@
+from operator import add, mul
+import numpy as np
+from scipy.sparse import identity
+
+from ramos.utils.matrix import MassOperator
+from ramos.utils.parallel import parmap, parimap, Pool
+from ramos.utils.parallel.shared import share, attach, free
+
+
+def mv_dot(vec, mx):
+    return mx.dot(vec)
+
+
+def test_parmap():
+    args = [(i, i+1) for i in range(20)]
+    assert parmap(mul, args, ncpus=3) == [a*b for a, b in args]
+    assert parmap(add, list(range(20)), (1,), unwrap=False, ncpus=3) == list(range(1, 21))
+    assert parmap(mul, args, reduction=sum, ncpus=3) == sum(a*b for a, b in args)
+    assert parmap(mul, args, ncpus=3, chunksize=4) == [a*b for a, b in args]
+    assert parmap(mul, args, reduction=sum, ncpus=3, chunksize=3) == sum(a*b for a, b in args)
+
+
+def test_parimap():
+    args = [(i, i+1) for i in range(50)]
+    assert list(parimap(mul, args, ncpus=3)) == [a*b for a, b in args]
+    assert list(parimap(mul, args, ncpus=3, chunksize=4, window=2)) == [a*b for a, b in args]
+
+
+def test_pool():
+    vecs = [np.arange(5, dtype=float) + i for i in range(10)]
+    with Pool(2) as pool:
+        handle = pool.broadcast((2 * identity(5, format='csr'),))
+        for _ in range(2):
+            result = parmap(mv_dot, vecs, handle, unwrap=False, pool=pool)
+            assert all(np.allclose(r, 2*v) for r, v in zip(result, vecs))
+        assert pool.map(add, [(1,), (2,)], (3,)) == [4, 5]
+        assert pool.map(add, [(i,) for i in range(9)], (3,), chunksize=2) == list(range(3, 12))
+        assert len(pool.busy) == 2
+        stream = pool.imap(add, [(i,) for i in range(9)], (3,), window=1)
+        assert next(stream) == 3
+        stream.close()
+        assert pool.map(add, [(1,), (2,)], (3,)) == [4, 5]
+
+
+def test_shared():
+    mx = 2 * identity(5, format='csr')
+    args, blocks = share((mx, np.ones(3), 'x'))
+    try:
+        (smx, arr, x), views = attach(args)
+        assert np.allclose(smx.toarray(), mx.toarray())
+        assert np.allclose(arr, 1) and x == 'x'
+        del smx, arr
+        free(views)
+    finally:
+        free(blocks, unlink=True)
+
+    vecs = [np.arange(5, dtype=float) + i for i in range(10)]
+    with Pool(2, share_threshold=0) as pool:
+        result = parmap(mv_dot, vecs, (mx,), unwrap=False, pool=pool)
+        assert all(np.allclose(r, 2*v) for r, v in zip(result, vecs))
+        op = MassOperator([identity(5, format='csr')], [1], [3.0])
+        result = parmap(mv_dot, vecs, (op,), unwrap=False, pool=pool)
+        assert all(np.allclose(r, 3*v) for r, v in zip(result, vecs))
@@ -0,0 +1,213 @@
+from click.testing import CliRunner
+import numpy as np
+import pytest
+from scipy.sparse import diags
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+
+from ramos import io
+from ramos.__main__ import main
+from ramos.io.Base import DataSource
+from ramos.reduction import Reduction, svd_update, mass_factor, is_diagonal
+from ramos.utils.vtk import write_to_file
+
+
+class ArraySource(DataSource):
+    """A data source with a single field, whose snapshots are the rows of a
+    matrix, with interleaved components.
+    """
+
+    def __init__(self, snapshots, mass, ncomps):
+        super(ArraySource, self).__init__(1, len(snapshots))
+        self.snapshots = snapshots
+        self.mass = mass.tocoo()
+        self.add_field('u', ncomps, mass.shape[0])
+
+    def field_mass_matrix(self, field):
+        return self.mass.data, self.mass.row, self.mass.col
+
+    def field_coefficients(self, field, level=0):
+        return self.snapshots[level].copy()
+
+    def tesselate(self, field, variates=None, level=0, condition=None):
+        raise NotImplementedError
+
+    def sink(self, *args, **kwargs):
+        return ArraySink()
+
+
+class ArraySink:
+
+    def __init__(self):
+        self.modes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, backtrace):
+        pass
+
+    def add_level(self, level):
+        pass
+
+    def write_fields(self, level, coeffs, fields):
+        self.modes[level] = np.array(coeffs)
+
+
+def reduction_data(diagonal):
+    """Snapshots with a decaying spectrum, and a mass matrix."""
+    rng = np.random.RandomState(0)
+    nsnaps, npts, ncomps = 20, 30, 2
+    left = np.linalg.qr(rng.standard_normal((nsnaps, nsnaps)))[0]
+    right = np.linalg.qr(rng.standard_normal((npts * ncomps, nsnaps)))[0]
+    snapshots = (left * np.logspace(0, -4, nsnaps)).dot(right.T)
+    if diagonal:
+        mass = diags(rng.uniform(1, 2, npts), format='csr')
+    else:
+        mass = diags([1, 4, 1], [-1, 0, 1], shape=(npts, npts), format='csr')
+    return snapshots, mass, ncomps
+
+
+def test_svd_update():
+    rng = np.random.RandomState(0)
+    snapshots = rng.standard_normal((40, 12))
+    mass = diags(rng.uniform(1, 2, 40), format='csr')
+
+    # Reference: eigenvalues of the covariance matrix
+    corrmx = snapshots.T.dot(mass.dot(snapshots))
+    eigvals = np.linalg.eigvalsh(corrmx)[::-1]
+
+    modes, values, energy = np.zeros((40, 0)), np.zeros((0,)), 0.0
+    for cols in [slice(0, 5), slice(5, 6), slice(6, 12)]:
+        modes, values, e = svd_update(modes, values, snapshots[:,cols], mass)
+        energy += e
+
+    assert np.allclose(values ** 2, eigvals)
+    assert np.isclose(energy, np.trace(corrmx))
+    assert np.allclose(modes.T.dot(mass.dot(modes)), np.eye(12))
+
+
+def test_svd_update_truncation():
+    rng = np.random.RandomState(0)
+    snapshots = rng.standard_normal((40, 30)) * np.logspace(0, -3, 30)
+    mass = diags(rng.uniform(1, 2, 40), format='csr')
+    total = np.sum(snapshots * mass.dot(snapshots))
+
+    # The error bound must hold for the accumulated truncation, not only for
+    # each update separately
+    tol = 0.05
+    modes, values, energy = np.zeros((40, 0)), np.zeros((0,)), 0.0
+    for start in range(0, 30, 3):
+        modes, values, e = svd_update(
+            modes, values, snapshots[:,start:start+3], mass, tol, total=energy
+        )
+        energy += e
+
+    assert np.isclose(energy, total)
+    assert len(values) < 30
+    resid = snapshots - modes.dot(modes.T.dot(mass.dot(snapshots)))
+    assert np.sum(resid * mass.dot(resid)) <= tol ** 2 * total * (1 + 1e-10)
+
+
+def test_mass_factor():
+    rng = np.random.RandomState(0)
+    mass = diags(rng.uniform(1, 2, 10), format='csr')
+    assert is_diagonal(mass)
+    assert np.allclose(mass_factor(mass) ** 2, mass.diagonal())
+
+    mass = diags([1, 4, 1], [-1, 0, 1], shape=(10, 10), format='csr')
+    assert not is_diagonal(mass)
+    factor = mass_factor(mass)
+    assert np.allclose(factor.dot(factor.T), mass.toarray())
+    assert mass_factor(-mass) is None
+
+
+@pytest.mark.parametrize('method,solver,diagonal', [
+    ('snapshots', 'eigh', False),
+    ('snapshots', 'lanczos', False),
+    ('snapshots', 'randomized', False),
+    ('svd', 'eigh', False),
+    ('svd', 'eigh', True),
+])
+def test_reduce(tmp_path, method, solver, diagonal):
+    snapshots, mass, ncomps = reduction_data(diagonal)
+    source = ArraySource(snapshots, mass, ncomps)
+    sink = source.sink()
+    output = str(tmp_path / 'out')
+    nmodes = 4
+
+    reduction = Reduction(
+        [source], ['u'], sink, output, min_modes=nmodes, error=1e-3, ncpus=2,
+        scratch=str(tmp_path), block_bytes=800, solver=solver, method=method,
+    )
+    reduction.reduce()
+
+    # Dense reference: eigenpairs of the covariance matrix, and the modes
+    # normalized with respect to the mass matrix
+    fullmass = source.mass_matrix('u').toarray()
+    corrmx = snapshots.dot(fullmass).dot(snapshots.T)
+    eigvals, eigvecs = np.linalg.eigh(corrmx)
+    eigvals, eigvecs = eigvals[::-1][:nmodes], eigvecs[:,::-1][:,:nmodes]
+    modes = snapshots.T.dot(eigvecs) / np.sqrt(eigvals)
+
+    spectrum = np.loadtxt(output + '.csv')
+    assert np.allclose(spectrum[:nmodes,1], eigvals / np.trace(corrmx))
+
+    assert len(sink.modes) >= nmodes
+    for i in range(nmodes):
+        mode = sink.modes[i]
+        assert np.isclose(mode.dot(fullmass).dot(mode), 1.0)
+        assert np.allclose(mode * np.sign(mode.dot(modes[:,i])), modes[:,i], atol=1e-6)
+
+
+def write_quad_levels(path, values):
+    """Write a VTK file for each row of `values`, on a grid of quads."""
+    n = 5
+    points = vtk.vtkPoints()
+    for y in range(n):
+        for x in range(n):
+            points.InsertNextPoint(x / (n - 1), (y / (n - 1)) ** 2, 0.0)
+    path.mkdir()
+    for level, row in enumerate(values):
+        grid = vtk.vtkUnstructuredGrid()
+        grid.SetPoints(points)
+        for y in range(n - 1):
+            for x in range(n - 1):
+                k = y * n + x
+                grid.InsertNextCell(vtk.VTK_QUAD, 4, [k, k + 1, k + n + 1, k + n])
+        array = numpy_to_vtk(row.reshape(n * n, -1), deep=1)
+        array.SetName('u')
+        grid.GetPointData().AddArray(array)
+        write_to_file(grid, str(path / 'data-{}.vtk'.format(level)))
+
+
+def test_project(tmp_path):
+    rng = np.random.RandomState(0)
+    snapshots = rng.standard_normal((7, 50))
+    basis = rng.standard_normal((3, 50))
+    write_quad_levels(tmp_path / 'source', snapshots)
+    write_quad_levels(tmp_path / 'basis', basis)
+
+    # Reference: projection of each snapshot, one mode at a time, with the
+    # values as stored in the files
+    source, target = (io.load(str(tmp_path / name)) for name in ('source', 'basis'))
+    mass = source.mass_matrix('u').toarray()
+    modes = [target.coefficients(['u'], level) for level in target.levels()]
+    expected = [
+        sum(mode.dot(mass).dot(vector) * mode for mode in modes)
+        for vector in (source.coefficients(['u'], level) for level in source.levels())
+    ]
+
+    # Small blocks, so that several blocks of levels are projected
+    runner = CliRunner()
+    for options in ([], ['--block-bytes', '1000']):
+        out = str(tmp_path / 'out{}'.format(len(options)))
+        result = runner.invoke(main, [
+            '--no-mass-cache', 'project', '-t', str(tmp_path / 'basis'), '-o', out,
+            *options, str(tmp_path / 'source'),
+        ])
+        assert result.exit_code == 0, result.output
+        output = io.load(out)
+        assert output.ntimes == len(snapshots)
+        for level, recons in zip(output.levels(), expected):
+            assert np.allclose(output.coefficients(['u'], level), recons, rtol=0, atol=1e-8)
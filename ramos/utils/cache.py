@@ -0,0 +1,176 @@
+from collections import OrderedDict
+import logging
+import numpy as np
+import os
+from os.path import expanduser, isdir, join
+import tempfile
+
+
+class LRUCache:
+    """A bounded cache that evicts the least recently used entries first.
+
+    The cache may be bounded by the number of entries (`maxcount`), by their
+    total size in bytes (`maxbytes`, which requires a `sizeof` function), or
+    both. The most recently added entry is always kept, even if it alone
+    exceeds the bounds.
+
+    When pickled, the entries are dropped, so that objects holding a cache
+    can be sent to worker processes (which will get an empty cache with the
+    same bounds).
+    """
+
+    def __init__(self, maxcount=None, maxbytes=None, sizeof=None):
+        if maxbytes is not None and sizeof is None:
+            raise ValueError('A sizeof function is required to bound the size in bytes')
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def clear(self):
+        """Remove all entries."""
+        self.entries = OrderedDict()    # Map keys to (value, size) tuples
+        self.nbytes = 0
+
+    def get(self, key, factory):
+        """Return the entry for `key`. If there is no such entry, call `factory`
+        with no arguments to create one.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        value = factory()
+        size = self.sizeof(value) if self.sizeof else 0
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        self.evict()
+        return value
+
+    def overfull(self):
+        """Check whether the cache exceeds its bounds."""
+        if self.maxcount is not None and len(self.entries) > self.maxcount:
+            return True
+        return self.maxbytes is not None and self.nbytes > self.maxbytes
+
+    def evict(self):
+        """Remove entries until the cache is within its bounds."""
+        while len(self.entries) > 1 and self.overfull():
+            _, (_, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+
+
+def default_cache_dir():
+    """The default directory for on-disk caches, following the XDG base
+    directory specification.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache')
+    return join(base, 'ramos')
+
+
+class DiskCache:
+    """A persistent cache of collections of numpy arrays, stored as .npz files
+    in a directory. Each entry is a dictionary mapping names to arrays.
+
+    The total size of the files is bounded by `maxbytes`, and the least
+    recently used entries are evicted first (based on the modification
+    times of the files, which are updated on every hit).
+
+    Entries are written atomically, so several processes may share the same
+    cache directory. Unreadable entries are treated as missing.
+    """
+
+    def __init__(self, path=None, maxbytes=2**30):
+        self.path = path or default_cache_dir()
+        self.maxbytes = maxbytes
+
+    def filename(self, key):
+        """The name of the file storing the entry for `key`."""
+        return join(self.path, key + '.npz')
+
+    def get(self, key, factory):
+        """Return the entry for `key`. If there is no such entry, call `factory`
+        with no arguments to create one, and store it.
+        """
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as f:
+                value = dict(f)
+            os.utime(filename)
+            logging.debug('Loaded %s from cache', key)
+            return value
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning('Discarding unreadable cache entry %s: %s', filename, e)
+
+        value = factory()
+        try:
+            self.put(key, value)
+        except OSError as e:
+            logging.warning('Unable to write to cache: %s', e)
+        return value
+
+    def put(self, key, value):
+        """Store an entry, replacing any existing entry with the same key."""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **value)
+            os.replace(tmp, self.filename(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Return a list of (mtime, size, filename) tuples for all entries, from
+        least to most recently used.
+        """
+        if not isdir(self.path):
+            return []
+        ret = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                ret.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(ret)
+
+    def evict(self):
+        """Remove entries until the cache is within its bounds. The most
+        recently used entry is always kept.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries[:-1]:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        for _, _, filename in self.entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
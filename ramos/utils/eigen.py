@@ -0,0 +1,62 @@
+"""Eigensolvers for symmetric positive semi-definite matrices, such as POD
+covariance matrices.
+
+Each solver is called as solver(mx, k), and returns the k (or more) largest
+eigenvalues of `mx` in descending order, together with a matrix whose
+columns are the corresponding eigenvectors.
+"""
+
+import numpy as np
+from scipy.sparse.linalg import eigsh
+
+
+__all__ = ['SOLVERS']
+
+
+def eigh(mx, k):
+    """Dense eigenvalue decomposition. Always returns the full spectrum."""
+    eigvals, eigvecs = np.linalg.eigh(mx)
+    return eigvals[::-1], eigvecs[:,::-1]
+
+
+def lanczos(mx, k):
+    """Implicitly restarted Lanczos method (ARPACK), which only computes the k
+    largest eigenpairs.
+    """
+    # ARPACK can't compute the full spectrum
+    if k >= mx.shape[0] - 1:
+        return eigh(mx, k)
+    eigvals, eigvecs = eigsh(mx, k=k, which='LA')
+    order = np.argsort(eigvals)[::-1]
+    return eigvals[order], eigvecs[:,order]
+
+
+def randomized(mx, k, oversampling=10, niter=4, seed=0):
+    """Randomized range finder with power iterations (Halko, Martinsson and
+    Tropp, 2011), which approximates the k largest eigenpairs.
+
+    - `oversampling`: number of extra directions to sample
+    - `niter`: number of power iterations, which improve accuracy when the
+      spectrum decays slowly
+    - `seed`: seed for the random number generator
+    """
+    n = mx.shape[0]
+    ncols = k + oversampling
+    if ncols >= n:
+        return eigh(mx, k)
+
+    rng = np.random.RandomState(seed)
+    q, _ = np.linalg.qr(mx.dot(rng.standard_normal((n, ncols))))
+    for _ in range(niter):
+        q, _ = np.linalg.qr(mx.dot(q))
+
+    # Solve the eigenvalue problem projected on the range of q
+    eigvals, eigvecs = eigh(q.T.dot(mx).dot(q), k)
+    return eigvals[:k], q.dot(eigvecs[:,:k])
+
+
+SOLVERS = {
+    'eigh': eigh,
+    'lanczos': lanczos,
+    'randomized': randomized,
+}
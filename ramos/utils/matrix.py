@@ -1,19 +1,91 @@
-from itertools import chain
 import numpy as np
 from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
+
+
+def scalar_matrix(data, rows, cols, size=None):
+    """Assemble a square CSR matrix from element data, as returned by the
+    various mass matrix functions. Duplicate entries are summed.
+    """
+    shape = (size, size) if size is not None else None
+    mx = csr_matrix((data, (rows, cols)), shape=shape)
+    mx.sum_duplicates()
+    return mx
+
+
+def interleave(mx, ncomps):
+    """Expand a scalar CSR matrix to a matrix acting on vectors with `ncomps`
+    interleaved components, i.e. the Kronecker product of `mx` with an
+    identity matrix of size `ncomps`.
+
+    The expanded matrix is constructed directly in CSR form, so that no
+    intermediate arrays larger than the result are needed.
+    """
+    mx = csr_matrix(mx)
+    if ncomps == 1:
+        return mx
+    mx.sum_duplicates()
+
+    # Row i of the scalar matrix is duplicated in rows ncomps*i + c for each
+    # component c, with column indices ncomps*j + c.
+    nrows = mx.shape[0]
+    row_nnz = np.diff(mx.indptr)
+    indptr = np.zeros((nrows * ncomps + 1,), dtype=mx.indptr.dtype)
+    np.cumsum(np.repeat(row_nnz, ncomps), out=indptr[1:])
+
+    row_of = np.repeat(np.arange(nrows), row_nnz)
+    local = np.arange(mx.nnz) - mx.indptr[row_of]
+    data = np.empty((mx.nnz * ncomps,), dtype=mx.dtype)
+    indices = np.empty((mx.nnz * ncomps,), dtype=mx.indices.dtype)
+    for c in range(ncomps):
+        pos = indptr[ncomps * row_of + c] + local
+        data[pos] = mx.data
+        indices[pos] = ncomps * mx.indices + c
+
+    shape = (mx.shape[0] * ncomps, mx.shape[1] * ncomps)
+    ret = csr_matrix((data, indices, indptr), shape=shape)
+    ret.has_sorted_indices = True
+    return ret
+
+
+def block_diagonal(blocks):
+    """Construct a block diagonal CSR matrix by concatenating the arrays of
+    CSR matrices directly.
+    """
+    blocks = [csr_matrix(b) for b in blocks]
+    nrows = sum(b.shape[0] for b in blocks)
+    ncols = sum(b.shape[1] for b in blocks)
+    nnz = sum(b.nnz for b in blocks)
+    index_dtype = np.int64 if max(nrows, ncols, nnz) > np.iinfo(np.int32).max else np.int32
+
+    data = np.empty((nnz,), dtype=np.result_type(*(b.dtype for b in blocks)))
+    indices = np.empty((nnz,), dtype=index_dtype)
+    indptr = np.zeros((nrows + 1,), dtype=index_dtype)
+
+    row, col, pos = 0, 0, 0
+    for b in blocks:
+        data[pos:pos+b.nnz] = b.data
+        indices[pos:pos+b.nnz] = b.indices + col
+        indptr[row+1:row+b.shape[0]+1] = b.indptr[1:] + pos
+        row += b.shape[0]
+        col += b.shape[1]
+        pos += b.nnz
+
+    return csr_matrix((data, indices, indptr), shape=(nrows, ncols))
 
 
 class MatrixBuilder:
     """Utility class for constructing mass matrices.
 
-    To use, call the add() method as many times as necessary, then the build()
-    method to construct a Scipy sparse CSR format matrix.
+    To use, call the add() or add_matrix() methods as many times as
+    necessary, then the build() method to construct a Scipy sparse CSR format
+    matrix. Each call adds a diagonal block to the matrix.
     """
 
     def __init__(self):
         self.data = []
 
-    def add(self, data, rows, cols, ncomps=1, scale=1.0):
+    def add(self, data, rows, cols, ncomps=1, scale=1.0, size=None):
         """Add data to this matrix.
 
         `data` is a one-dimensional numpy array of matrix elements.
@@ -22,32 +94,93 @@ class MatrixBuilder:
         `ncomps` is an optional number of components (multiple components has
         the effect of "duplicating" the data).
         `scale` is an optional scaling factor to apply.
+        `size` is the number of rows and columns of the (scalar) block. If
+        not given, it is inferred from the largest indices.
+        """
+        self.add_matrix(scalar_matrix(data, rows, cols, size), ncomps, scale)
+
+    def add_matrix(self, mx, ncomps=1, scale=1.0):
+        """Add a scalar sparse matrix to this matrix, with an optional number of
+        components and scaling factor (see add()).
         """
         self.data.append({
-            'data': data * scale,
-            'rows': rows,
-            'cols': cols,
+            'matrix': mx,
             'ncomps': ncomps,
+            'scale': scale,
         })
 
     def build(self):
         """Finalize the matrix."""
-
-        # First, we need to create global data, rows and cols arrays.
-        data, rows, cols = [], [], []
-        glob_index = 0
+        blocks = []
         for d in self.data:
-            ncomps = d['ncomps']
-            data.extend([d['data']] * ncomps)
-
-            # The rows and cols arrays are locally indexed from zero, so we
-            # must transform them to the global matrix index system.
-            for i in range(ncomps):
-                rows.append(ncomps * d['rows'] + glob_index + i)
-                cols.append(ncomps * d['cols'] + glob_index + i)
-            glob_index += ncomps * len(d['data'])
-
-        data, rows, cols = map(np.hstack, (data, rows, cols))
-        mx = csr_matrix((data, (rows, cols)))
-        mx.sum_duplicates()
-        return mx
+            mx = interleave(d['matrix'], d['ncomps'])
+            if d['scale'] != 1.0:
+                mx = mx * d['scale']
+            blocks.append(mx)
+        return block_diagonal(blocks)
+
+
+class MassOperator(LinearOperator):
+    """Mass matrix for one or more fields, applied to coefficient vectors with
+    interleaved components without assembling the full matrix.
+
+    Only one scalar matrix is stored for each field, which is applied to all
+    the components at once. The operator supports the usual matrix-vector
+    and matrix-matrix products (`matvec`, `matmat` and `dot`), and can be
+    assembled with tocsr() if necessary.
+    """
+
+    def __init__(self, matrices, ncomps, scales=None):
+        """Create a mass operator.
+
+        - `matrices`: scalar sparse matrices, one for each field
+        - `ncomps`: number of components of each field
+        - `scales`: optional scaling factor for each field
+        """
+        self.matrices = list(matrices)
+        self.ncomps = list(ncomps)
+        self.scales = list(scales) if scales is not None else [1.0] * len(self.matrices)
+        size = sum(mx.shape[0] * nc for mx, nc in zip(self.matrices, self.ncomps))
+        dtype = np.result_type(*(mx.dtype for mx in self.matrices))
+        super(MassOperator, self).__init__(dtype, (size, size))
+
+    @property
+    def nnz(self):
+        """Number of nonzeros in the assembled matrix."""
+        return sum(mx.nnz * nc for mx, nc in zip(self.matrices, self.ncomps))
+
+    def blocks(self):
+        """Iterate over tuples (slice, matrix, ncomps, scale) for each field."""
+        start = 0
+        for mx, nc, scale in zip(self.matrices, self.ncomps, self.scales):
+            stop = start + mx.shape[0] * nc
+            yield slice(start, stop), mx, nc, scale
+            start = stop
+
+    def _matvec(self, x):
+        return self._matmat(x.reshape(-1, 1)).reshape(x.shape)
+
+    def _matmat(self, x):
+        nvecs = x.shape[1]
+        out = np.empty((self.shape[0], nvecs), dtype=np.result_type(self.dtype, x.dtype))
+        for sl, mx, nc, scale in self.blocks():
+            # With interleaved components, the coefficients of a field form
+            # a matrix with one row per point, so a single product with the
+            # scalar matrix covers all components of all vectors.
+            coeffs = np.reshape(x[sl], (mx.shape[0], nc * nvecs))
+            result = mx.dot(coeffs)
+            if scale != 1.0:
+                result *= scale
+            out[sl] = np.reshape(result, (-1, nvecs))
+        return out
+
+    def _adjoint(self):
+        # Mass matrices are symmetric
+        return self
+
+    def tocsr(self):
+        """Assemble the matrix in CSR form."""
+        builder = MatrixBuilder()
+        for _, mx, nc, scale in self.blocks():
+            builder.add_matrix(mx, nc, scale)
+        return builder.build()
@@ -4,20 +4,32 @@ import numpy as np
 def mesh_filter(x, y, cell_indices, cond=None):
     """Filters the mesh given by x, y and cell_indices according to cond (an array
     of valid indices). Returns a triangular mesh.
+
+    Each cell is reduced to its points that satisfy the condition (in
+    order), and these are split into the triangles (0, 1, 2), (1, 2, 3), etc.
     """
+    npts = x.shape[0]
     if cond is None:
-        cond = np.arange(x.shape[0])
-        ind_conv = np.arange(x.shape[0])
-        test = set(ind_conv)
-    else:
-        ind_conv = np.zeros(x.shape, dtype=np.int)
-        ind_conv[cond] = np.arange(len(cond))
-        test = set(cond)
+        cond = np.arange(npts)
+
+    # Conversion from old to new point indices, with -1 for removed points
+    ind_conv = np.empty((npts,), dtype=int)
+    ind_conv[:] = -1
+    ind_conv[cond] = np.arange(len(cond))
+
+    # Convert all the cells, then move the remaining points in each cell to
+    # the front, preserving their order
+    cell_indices = np.asarray(cell_indices)
+    converted = np.where(cell_indices >= 0, ind_conv[cell_indices], -1)
+    keep = converted >= 0
+    order = np.argsort(~keep, axis=1, kind='stable')
+    converted = np.take_along_axis(converted, order, axis=1)
 
-    final_indices = []
-    for cell in cell_indices:
-        cell = [ind_conv[c] for c in cell if c in test]
-        new_cells = [cell[k:k+3] for k in range(0, len(cell) - 2)]
-        final_indices.extend(new_cells)
+    # A cell with n remaining points gives n - 2 triangles. Triangle k of a
+    # cell consists of its remaining points k, k+1 and k+2.
+    ntris = np.maximum(np.sum(keep, axis=1) - 2, 0)
+    cells = np.repeat(np.arange(len(converted)), ntris)
+    k = np.arange(np.sum(ntris)) - np.repeat(np.cumsum(ntris) - ntris, ntris)
+    final_indices = converted[cells[:, np.newaxis], k[:, np.newaxis] + np.arange(3)]
 
-    return x[cond], y[cond], np.array(final_indices)
+    return x[cond], y[cond], final_indices
@@ -1,10 +1,16 @@
-from itertools import chain
-from multiprocessing import Process, Queue
-from operator import itemgetter
+from itertools import chain, count, islice
+import logging
+from tqdm import tqdm
+from multiprocessing import Process, Queue, resource_tracker
+from queue import Empty
 import os
+import time
+import traceback
 
+from ramos.utils.parallel.shared import share, attach, free
 
-__all__ = ['parmap']
+
+__all__ = ['parmap', 'parimap', 'Pool']
 
 
 def split(lst, n):
@@ -13,71 +19,389 @@ def split(lst, n):
     return [lst[i*k+min(i,m):(i+1)*k+min(i+1,m)] for i in range(n)]
 
 
-def delegate(pid, q, target, chunk, args, reduction):
-    """Worker function for use in parmap.
+def chunked(lst, size):
+    """Split a list `lst` into blocks of the given size (the last one may be smaller)."""
+    return [lst[i:i+size] for i in range(0, len(lst), size)]
+
+
+def worker(wid, inbox, outbox):
+    """Main loop of a worker process in a pool.
+
+    - `wid`: The ID of this worker process
+    - `inbox`: Queue from which messages to this worker are read
+    - `outbox`: Queue to which results will be sent
+
+    The following messages are understood:
+    - ('broadcast', key, args): store the tuple of constant arguments `args`,
+      attaching to shared memory if necessary (see ramos.utils.parallel.shared)
+    - ('release', key): forget the constant arguments stored under `key`, and
+      acknowledge by putting ('released', key, wid, None) to the queue `outbox`
+    - ('task', tid, target, chunk, key, reduction): call `target` for each
+      argument tuple in `chunk`, followed by the constant arguments stored
+      under `key`, and reduce the result with `reduction` (if not None)
+    - ('stop',): exit the loop
+
+    For each task, will put either the tuple ('result', tid, wid, (<busy>,
+    <result>)) or ('error', tid, wid, <traceback>) to the queue `outbox`,
+    where <busy> is the time spent working on the task.
+    """
+    constants = {}
+    while True:
+        msg = inbox.get()
+        kind = msg[0]
+        if kind == 'stop':
+            break
+        elif kind == 'broadcast':
+            _, key, args = msg
+            constants[key] = attach(args)
+        elif kind == 'release':
+            _, key = msg
+            _, blocks = constants.pop(key)
+            free(blocks)
+            outbox.put(('released', key, wid, None))
+        elif kind == 'task':
+            _, tid, target, chunk, key, reduction = msg
+            try:
+                start = time.perf_counter()
+                args, _ = constants[key]
+                result = [target(*c, *args) for c in chunk]
+                if reduction:
+                    result = reduction(result)
+                busy = time.perf_counter() - start
+                outbox.put(('result', tid, wid, (busy, result)))
+            except Exception:
+                outbox.put(('error', tid, wid, traceback.format_exc()))
+
+
+class Handle:
+    """A reference to a tuple of constant arguments that has been broadcast to
+    all the workers of a pool. Pass it as the `constant` argument to
+    Pool.map() or parmap() to avoid sending the arguments again.
+    """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+
+class Pool:
+    """A pool of long-lived worker processes.
+
+    Use as a context manager. The workers are started when the context is
+    entered and shut down when it is exited. In between, any number of calls
+    to map() (or parmap() with the `pool` argument) may be dispatched on the
+    same set of processes.
 
-    - `pid`: The ID of this worker process
-    - `q`: Queue to which result will be sent
-    - `target`: The worker function that will actually do the work
-    - `chunk`: List of argument tuples
-    - `args`: Tuple of constant arguments
-    - `reduction`: Function to reduce the result, or None
+    Large constant arguments, such as mass matrices, can be sent to the
+    workers once with broadcast(), and then referred to by the returned
+    handle. Arrays and sparse matrices among them are placed in shared memory
+    rather than copied to each worker.
 
-    Will put the tuple (pid, <result>) to the queue `q`.
+    After each call to map(), the attribute `busy` holds the time each worker
+    spent working, which can be used to diagnose load imbalance.
     """
-    result = []
-    for c in chunk:
-        cur_args = list(c) + list(args)
-        result.append(target(*cur_args))
 
-    if reduction:
-        q.put((pid, reduction(result)))
-    else:
-        q.put((pid, result))
+    def __init__(self, ncpus=None, share_threshold=2**20):
+        """Create a pool with `ncpus` workers (by default, the number of CPUs).
+
+        Broadcast arrays and sparse matrices of at least `share_threshold`
+        bytes are placed in shared memory. Set to None to disable.
+        """
+        self.ncpus = ncpus or os.cpu_count()
+        self.share_threshold = share_threshold
+        self.workers = []
+        self.keys = {}          # Map keys to lists of owned shared memory blocks
+        self.busy = []
+        self._key_counter = count()
+        self._tid_counter = count()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, backtrace):
+        if type_ is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def start(self):
+        """Start the worker processes."""
+
+        # The workers must share a resource tracker with the parent, otherwise
+        # they will each try to clean up shared memory owned by the parent
+        resource_tracker.ensure_running()
+
+        self.outbox = Queue()
+        for wid in range(self.ncpus):
+            inbox = Queue()
+            p = Process(target=worker, args=(wid, inbox, self.outbox), daemon=True)
+            p.start()
+            self.workers.append((inbox, p))
+
+    def close(self):
+        """Release all constants and shut down the workers gracefully."""
+        for key in list(self.keys):
+            self.release(Handle(self, key))
+        for inbox, _ in self.workers:
+            inbox.put(('stop',))
+        for _, p in self.workers:
+            p.join()
+        self.workers = []
+
+    def terminate(self):
+        """Shut down the workers immediately."""
+        for _, p in self.workers:
+            p.terminate()
+        for _, p in self.workers:
+            p.join()
+        self.workers = []
+        for blocks in self.keys.values():
+            free(blocks, unlink=True)
+        self.keys = {}
+
+    def broadcast(self, constant=()):
+        """Send a tuple of constant arguments to all workers, and return a handle
+        that refers to it.
+        """
+        key = next(self._key_counter)
+        if self.share_threshold is None:
+            args, blocks = tuple(constant), []
+        else:
+            args, blocks = share(tuple(constant), self.share_threshold)
+        self.keys[key] = blocks
+        for inbox, _ in self.workers:
+            inbox.put(('broadcast', key, args))
+        return Handle(self, key)
+
+    def release(self, handle):
+        """Tell all workers to forget a tuple of constant arguments."""
+        for inbox, _ in self.workers:
+            inbox.put(('release', handle.key))
+
+        # Shared memory may only be unlinked once all the workers have
+        # attached to it, so wait for them to acknowledge
+        nacks = 0
+        while nacks < len(self.workers):
+            kind, key, _, _ = self._get()
+            if kind == 'released' and key == handle.key:
+                nacks += 1
+        free(self.keys.pop(handle.key), unlink=True)
+
+    def _get(self):
+        """Read a message from the workers, failing if any of them have died."""
+        while True:
+            try:
+                return self.outbox.get(timeout=1)
+            except Empty:
+                if not all(p.is_alive() for _, p in self.workers):
+                    raise RuntimeError('A worker process died unexpectedly')
+
+    def _run(self, target, chunks, key, reduction, dynamic=False, prefetch=2, window=None):
+        """Run a list of chunks on the workers, and yield the results in order.
+
+        If `dynamic` is false, chunk i is assigned to worker i (modulo the
+        number of workers) up front. Otherwise, each worker is given
+        `prefetch` chunks to begin with, and then a new chunk each time it
+        returns a result, so that faster workers get more of the work.
 
+        In dynamic mode, `window` optionally bounds the number of chunks that
+        may be submitted beyond the first one that has not been yielded yet.
+        This limits the number of results held in memory at any one time.
+        """
+        nworkers = len(self.workers)
+        queue = enumerate(chunks)
+        tids = {}               # Map task IDs to chunk indices
+        done = {}               # Map chunk indices to results
+        idle = []               # Workers waiting for the window to advance
+        nextindex = 0           # Index of the next chunk to yield
+        nsubmitted = 0
+        self.busy = [0.0] * nworkers
 
-def parmap(target, varying, constant=(), reduction=None, ncpus=None, unwrap=True):
+        def submit(wid):
+            nonlocal nsubmitted
+            if window and nsubmitted >= nextindex + window:
+                idle.append(wid)
+                return
+            for i, chunk in islice(queue, 1):
+                tid = next(self._tid_counter)
+                self.workers[wid][0].put(('task', tid, target, chunk, key, reduction))
+                tids[tid] = i
+                nsubmitted += 1
+
+        # In static mode, the queue is exhausted here
+        ninitial = prefetch * nworkers if dynamic else len(chunks)
+        for i in range(ninitial):
+            submit(i % nworkers)
+
+        # Results may arrive out of order, and there may be stale results left
+        # over from a previous failed call, which we ignore
+        while tids or done:
+            while nextindex not in done:
+                kind, tid, wid, payload = self._get()
+                if kind not in {'result', 'error'} or tid not in tids:
+                    continue
+                if kind == 'error':
+                    raise RuntimeError('Exception in worker process:\n{}'.format(payload))
+                busy, result = payload
+                self.busy[wid] += busy
+                done[tids.pop(tid)] = result
+                submit(wid)
+            yield done.pop(nextindex)
+            nextindex += 1
+
+            # The window has advanced, so idle workers may get more work
+            waiting, idle[:] = idle[:], []
+            for wid in waiting:
+                submit(wid)
+
+    def report(self):
+        """Log the load balance of the previous call to map()."""
+        if not self.busy or max(self.busy) == 0.0:
+            return
+        mean = sum(self.busy) / len(self.busy)
+        logging.debug(
+            'Worker busy time: min %.2fs, mean %.2fs, max %.2fs (imbalance %.2f)',
+            min(self.busy), mean, max(self.busy), max(self.busy) / mean,
+        )
+
+    def map(self, target, varying, constant=(), reduction=None, chunksize=None):
+        """Parallel map on the workers of this pool.
+
+        - `target`: a function to be called on all inputs
+        - `varying`: a list of tuples of arguments to pass to the target function
+        - `constant`: a tuple of arguments to pass to the target function, or
+          a handle returned by broadcast()
+        - `reduction`: optional function to reduce the output
+        - `chunksize`: if given, split the inputs in chunks of this size, and
+          hand them out to the workers as they become idle. Otherwise, split
+          the inputs in one equally sized chunk per worker.
+
+        The target function must be written so that the variable arguments
+        come before the constant ones.
+        """
+        if isinstance(constant, Handle):
+            assert constant.pool is self
+            handle = constant
+        else:
+            handle = self.broadcast(constant)
+
+        try:
+            if chunksize:
+                chunks = chunked(varying, chunksize)
+            else:
+                chunks = split(varying, self.ncpus)
+            result = list(self._run(target, chunks, handle.key, reduction, dynamic=bool(chunksize)))
+        finally:
+            if handle is not constant:
+                self.release(handle)
+        self.report()
+
+        # Return either reduction or flattened list
+        if reduction:
+            return reduction(result)
+        return list(chain.from_iterable(result))
+
+    def imap(self, target, varying, constant=(), chunksize=1, window=None, progress=None):
+        """Parallel map on the workers of this pool, yielding the results in order as
+        they become available.
+
+        - `target`: a function to be called on all inputs
+        - `varying`: a list of tuples of arguments to pass to the target function
+        - `constant`: a tuple of arguments to pass to the target function, or
+          a handle returned by broadcast()
+        - `chunksize`: number of inputs to send to a worker at a time
+        - `window`: maximal number of chunks that may be in flight or waiting
+          to be yielded (by default, four per worker)
+        - `progress`: if true, show a progress bar (if a string, use it as the
+          description)
+
+        The work is always distributed dynamically (see map).
+        """
+        if isinstance(constant, Handle):
+            assert constant.pool is self
+            handle = constant
+        else:
+            handle = self.broadcast(constant)
+        if window is None:
+            window = 4 * len(self.workers)
+
+        bar = None
+        if progress:
+            desc = progress if isinstance(progress, str) else None
+            bar = tqdm(desc=desc, total=len(varying))
+
+        try:
+            chunks = chunked(varying, chunksize)
+            for result in self._run(target, chunks, handle.key, None, dynamic=True, window=window):
+                yield from result
+                if bar is not None:
+                    bar.update(len(result))
+        finally:
+            if bar is not None:
+                bar.close()
+            if handle is not constant:
+                self.release(handle)
+        self.report()
+
+
+def parmap(target, varying, constant=(), reduction=None, ncpus=None, unwrap=True, pool=None,
+           chunksize=None):
     """Parallel map
 
     - `target`: a function to be called on all inputs
     - `varying`: a list of tuples of arguments to pass to the target function
-    - `constant`: a tuple of arguments to pass to the target function
+    - `constant`: a tuple of arguments to pass to the target function, or a
+      handle returned by Pool.broadcast()
     - `reduction`: optional function to reduce the output
     - `ncpus`: optionally, number of parallel workers to use
     - `unwrap`: if false, treat `varying` as a list of single arguments, rather
       than as a list of argument tuples
+    - `pool`: optionally, a running pool to dispatch the work on. If not
+      given, a temporary pool is created for this call only.
+    - `chunksize`: optionally, use dynamic load balancing with chunks of this
+      size (see Pool.map)
 
     The target function must be written so that the variable arguments come
     before the constant ones.
     """
-    if not ncpus:
-        ncpus = os.cpu_count()
     if not unwrap:
         varying = [(v,) for v in varying]
 
-    chunks = split(varying, ncpus)
-    q = Queue()                 # Return values will be read from the queue
+    if pool is not None:
+        return pool.map(target, varying, constant, reduction, chunksize)
 
-    # Start a process for each worker, and run the delegate function
-    processes = []
-    for pid, chunk in enumerate(chunks):
-        p = Process(
-            target=delegate,
-            args=(pid, q, target, chunk, constant, reduction),
-        )
-        p.start()
-        processes.append((pid, p))
+    # There's no point in starting more workers than there are inputs
+    ncpus = max(1, min(ncpus or os.cpu_count(), len(varying)))
+    with Pool(ncpus) as pool:
+        return pool.map(target, varying, constant, reduction, chunksize)
 
-    # Grab the results from each worker and shut them down
-    result = [q.get() for _ in range(ncpus)]
 
-    for pid, p in processes:
-        p.join()
+def parimap(target, varying, constant=(), ncpus=None, unwrap=True, pool=None,
+            chunksize=1, window=None, progress=None):
+    """Parallel map yielding results in order as they become available.
+
+    - `target`: a function to be called on all inputs
+    - `varying`: a list of tuples of arguments to pass to the target function
+    - `constant`: a tuple of arguments to pass to the target function, or a
+      handle returned by Pool.broadcast()
+    - `ncpus`: optionally, number of parallel workers to use
+    - `unwrap`: if false, treat `varying` as a list of single arguments, rather
+      than as a list of argument tuples
+    - `pool`: optionally, a running pool to dispatch the work on. If not
+      given, a temporary pool is created for this call only.
+    - `chunksize`, `window`, `progress`: see Pool.imap
+
+    Unlike parmap, only a bounded number of results are held in memory at any
+    one time, so the caller should consume them as they come.
+    """
+    if not unwrap:
+        varying = [(v,) for v in varying]
 
-    # Sort results by pid
-    result = [v for _, v in sorted(result, key=itemgetter(0))]
+    if pool is not None:
+        yield from pool.imap(target, varying, constant, chunksize, window, progress)
+        return
 
-    # Return either reduction or flattened list
-    if reduction:
-        return reduction(result)
-    return list(chain.from_iterable(result))
+    ncpus = max(1, min(ncpus or os.cpu_count(), len(varying)))
+    with Pool(ncpus) as pool:
+        yield from pool.imap(target, varying, constant, chunksize, window, progress)
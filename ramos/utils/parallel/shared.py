@@ -0,0 +1,160 @@
+"""Transport of large constant arguments to worker processes through shared
+memory, rather than through pickling.
+
+The parent process calls share() on the arguments, which copies large NumPy
+arrays and the data, indices and indptr arrays of Scipy sparse matrices into
+shared memory blocks, and replaces them with lightweight references. The
+workers call attach() on the references to obtain zero-copy views.
+"""
+
+from copy import copy
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from scipy.sparse import issparse
+
+from ramos.utils.matrix import MassOperator
+
+
+__all__ = ['share', 'attach', 'free']
+
+
+class SharedArray:
+    """Picklable reference to a NumPy array living in a shared memory block."""
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def create(cls, array):
+        """Copy an array to a new shared memory block. Returns the reference and
+        the block, which is owned by the caller.
+        """
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        return cls(block.name, array.shape, array.dtype), block
+
+    def attach(self):
+        """Return a read-only view of the array and the block that backs it."""
+        block = SharedMemory(name=self.name)
+        view = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        view.flags.writeable = False
+        return view, block
+
+
+class SharedSparse:
+    """Picklable reference to a compressed Scipy sparse matrix whose arrays live
+    in shared memory blocks.
+    """
+
+    def __init__(self, cls, shape, data, indices, indptr):
+        self.cls = cls
+        self.shape = shape
+        self.arrays = (data, indices, indptr)
+
+    def attach(self):
+        """Return the matrix and the blocks that back it."""
+        views, blocks = zip(*(a.attach() for a in self.arrays))
+        return self.cls(views, shape=self.shape, copy=False), list(blocks)
+
+
+def _nbytes(obj):
+    """Size of an array or of the arrays of a compressed sparse matrix."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+
+
+def share(obj, threshold=0):
+    """Move large arrays in `obj` to shared memory.
+
+    `obj` may be an array, a sparse matrix, a mass operator, or a (possibly
+    nested) tuple, list or dict of such. Arrays and compressed sparse matrices of at least
+    `threshold` bytes are moved, everything else is left as is.
+
+    Returns the transformed object and a list of the shared memory blocks
+    that were created. These are owned by the caller, and should be passed to
+    free() when no longer in use.
+    """
+    if isinstance(obj, (tuple, list)):
+        items, blocks = [], []
+        for item in obj:
+            item, b = share(item, threshold)
+            items.append(item)
+            blocks.extend(b)
+        return type(obj)(items), blocks
+
+    if isinstance(obj, dict):
+        items, blocks = {}, []
+        for key, item in obj.items():
+            items[key], b = share(item, threshold)
+            blocks.extend(b)
+        return items, blocks
+
+    if isinstance(obj, MassOperator):
+        obj = copy(obj)
+        obj.matrices, blocks = share(obj.matrices, threshold)
+        return obj, blocks
+
+    compressed = issparse(obj) and obj.format in {'csr', 'csc'}
+    if not (isinstance(obj, np.ndarray) or compressed) or _nbytes(obj) < threshold:
+        return obj, []
+
+    if isinstance(obj, np.ndarray):
+        ref, block = SharedArray.create(obj)
+        return ref, [block]
+
+    refs, blocks = zip(*(SharedArray.create(a) for a in (obj.data, obj.indices, obj.indptr)))
+    return SharedSparse(type(obj), obj.shape, *refs), list(blocks)
+
+
+def attach(obj):
+    """Inverse of share(), for use in worker processes.
+
+    Returns the object with all references to shared memory replaced by
+    zero-copy views, and a list of the shared memory blocks that must be kept
+    open for as long as the views are in use.
+    """
+    if isinstance(obj, (tuple, list)):
+        items, blocks = [], []
+        for item in obj:
+            item, b = attach(item)
+            items.append(item)
+            blocks.extend(b)
+        return type(obj)(items), blocks
+
+    if isinstance(obj, dict):
+        items, blocks = {}, []
+        for key, item in obj.items():
+            items[key], b = attach(item)
+            blocks.extend(b)
+        return items, blocks
+
+    if isinstance(obj, MassOperator):
+        obj = copy(obj)
+        obj.matrices, blocks = attach(obj.matrices)
+        return obj, blocks
+
+    if isinstance(obj, SharedArray):
+        view, block = obj.attach()
+        return view, [block]
+    if isinstance(obj, SharedSparse):
+        return obj.attach()
+    return obj, []
+
+
+def free(blocks, unlink=False):
+    """Close a list of shared memory blocks, and optionally unlink them (only
+    the owner should do this).
+    """
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # There are still views into this block. The memory will be
+            # unmapped once they are garbage collected.
+            pass
+        if unlink:
+            block.unlink()
@@ -9,7 +9,7 @@ def energy_content(source, level, field, mx):
     - `source`: the data source
     - `level`: the time level to read from
     - `field`: the name of the field to read
-    - `mx`: mass matrix
+    - `mx`: mass matrix (or MassOperator)
 
     Equivalent of u^T × M × u, where M is the mass matrix and U is the
     coefficient vector.
@@ -18,30 +18,28 @@ def energy_content(source, level, field, mx):
     return mx.dot(coeffs).dot(coeffs)
 
 
-def normalized_coeffs(source, level, fields, mass):
-    """Returns the coefficient vector of a number of fields, centered around
-    the component-wise mean.
+def stored_mm_dot(rows, store, store_m, mx):
+    """Computes matrix-vector products with a block of stored snapshots.
 
-    - `source`: the data source
-    - `level`: the time level to read from
-    - `fields`: the name of the fields to read
-    - `mx`: dict mapping field names to mass matrices
+    - `rows`: tuple (start, stop) of snapshot indices
+    - `store`: snapshot store to read from
+    - `store_m`: snapshot store to write the results to
+    - `mx`: the (symmetric) matrix
     """
-    ret = []
-    for field in fields:
-        mx = mass[field]
-        coeffs = source.coefficients(field, level, flatten=False)
-        mean = np.sum(mx.dot(coeffs), axis=0) / mx.sum()  # Compute component-wise means,
-        coeffs -= mean                                    # and subtract them.
-        ret.append(np.ndarray.flatten(coeffs))            # The result needs to be flattened.
-    return np.hstack(coeffs)
+    start, stop = rows
+    store_m[start:stop] = mx.dot(store[start:stop].T).T
 
 
-def mv_dot(vec, mx):
-    """Computes a matrix-vector product."""
-    return mx.dot(vec)
+def gram_tile(rows, cols, store, store_m):
+    """Computes a tile of the Gram matrix of stored snapshots.
 
+    - `rows`: tuple (start, stop) of snapshot indices
+    - `cols`: tuple (start, stop) of matrix-vector product indices
+    - `store`: snapshot store
+    - `store_m`: snapshot store with matrix-vector products
 
-def vv_dot(va, vb):
-    """Computes a vector-vector dot product."""
-    return va.dot(vb)
+    Returns the tuple (rows, cols, tile), where the tile is the matrix of all
+    dot products between the given snapshots and matrix-vector products.
+    """
+    tile = np.dot(store[slice(*rows)], store_m[slice(*cols)].T)
+    return rows, cols, tile
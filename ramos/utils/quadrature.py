@@ -181,3 +181,21 @@ def triangular(degree):
         ]
 
     return pts, wts
+
+
+def tetrahedral(degree):
+
+    if degree <= 1:
+        pts = [(1/4, 1/4, 1/4)]
+        wts = [1/6]
+
+    elif degree <= 2:
+        a = (5 + 3*sqrt(5)) / 20
+        b = (5 - sqrt(5)) / 20
+        pts = [(b, b, b), (a, b, b), (b, a, b), (b, b, a)]
+        wts = [1/24, 1/24, 1/24, 1/24]
+
+    else:
+        raise ValueError('Unsupported degree: {}'.format(degree))
+
+    return pts, wts
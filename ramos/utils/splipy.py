@@ -1,10 +1,10 @@
 from functools import reduce
-from itertools import chain, product
+from itertools import product
 import numpy as np
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix, diags, kron
 from tqdm import tqdm
 
-from ramos.utils.parallel import parmap
+from ramos.utils.parallel import parimap
 
 
 def element_mass_matrix(element, quadrature, patch, glob_index):
@@ -35,27 +35,95 @@ def element_mass_matrix(element, quadrature, patch, glob_index):
 
     # Forgive me
     bfun_indices = [
-        np.array(k) + i + glob_index
+        np.array(k) + i
         for i, k in zip(loc_indices, zip(*product(*(range(o) for o in patch.order()))))
     ]
-    indices = np.ravel_multi_index(bfun_indices, patch.shape, order='F')
+    indices = np.ravel_multi_index(bfun_indices, patch.shape, order='F') + glob_index
     indices = list(product(indices, repeat=2))
     row_inds = [i[0] for i in indices]
     col_inds = [i[1] for i in indices]
     return np.ndarray.flatten(mass), row_inds, col_inds
 
 
-def mass_matrix(patch, glob_index, parallel=True):
+def quadrature_points(knots, order):
+    """Return all the Gauss points and weights over the spans of a knot
+    vector, for a rule with `order` points per knot span.
+    """
+    x, w = np.polynomial.legendre.leggauss(order)
+    left, right = np.array(knots[:-1]), np.array(knots[1:])
+    pts = np.ravel((x[np.newaxis,:] + 1) / 2 * (right - left)[:,np.newaxis] + left[:,np.newaxis])
+    wts = np.ravel(w[np.newaxis,:] / 2 * (right - left)[:,np.newaxis])
+    return pts, wts
+
+
+def jacobian(patch, qpts):
+    """Compute the Jacobian determinant of a patch on a tensor grid of points."""
+    derivs = [
+        patch.derivative(*qpts, d=tuple(int(i == j) for j in range(patch.pardim)))
+        for i in range(patch.pardim)
+    ]
+    if patch.pardim == 1:
+        return np.linalg.norm(derivs[0], axis=-1)
+    if patch.pardim == 2:
+        J = np.cross(*derivs)
+        if patch.dimension == 3:
+            return np.linalg.norm(J, axis=-1)
+        return np.abs(J)
+    return np.abs(np.linalg.det(np.stack(derivs, axis=-1)))
+
+
+def tensor_mass_matrix(patch, glob_index):
+    """Compute the mass matrix of a patch at once, exploiting the tensor product
+    structure.
+
+    The univariate basis functions are evaluated once at all the Gauss points
+    in each direction. The values of the multivariate basis functions at all
+    the points of the quadrature grid then form the Kronecker product B of
+    the univariate matrices, and the mass matrix is B^T × W × B, where W is
+    the diagonal matrix of quadrature weights times the Jacobian.
+    """
+    qpts, qwts, evals = [], [], []
+    for basis, knots, order in zip(patch.bases, patch.knots(), patch.order()):
+        pts, wts = quadrature_points(knots, order + 1)
+        qpts.append(pts)
+        qwts.append(wts)
+        evals.append(csr_matrix(basis.evaluate(pts, sparse=True)))
+
+    # Both the quadrature points and the basis functions are numbered with
+    # the first direction running fastest (Fortran order)
+    weights = reduce(np.multiply.outer, qwts) * jacobian(patch, qpts)
+    B = reduce(lambda a, b: kron(b, a, format='csr'), evals)
+    mass = (B.T.dot(diags(np.ravel(weights, order='F'))).dot(B)).tocoo()
+    return mass.data, mass.row + glob_index, mass.col + glob_index
+
+
+def mass_matrix(patch, glob_index, parallel=True, vectorized=True):
+    """Compute the mass matrix of a patch, as a tuple of arrays (data, rows,
+    cols), where the rows and columns are offset by `glob_index`.
+
+    By default, the matrix is computed at once using the tensor product
+    structure (see tensor_mass_matrix). Otherwise, it is computed one element
+    at a time, optionally in parallel.
+    """
+    if vectorized:
+        return tensor_mass_matrix(patch, glob_index)
+
     spans = [list(zip(k[:-1], k[1:])) for k in patch.knots()]
     quadrature = [np.polynomial.legendre.leggauss(order + 1) for order in patch.order()]
 
     constant = (quadrature, patch, glob_index)
     if parallel:
-        ret = parmap(element_mass_matrix, list(product(*spans)), constant, unwrap=False)
+        ret = parimap(
+            element_mass_matrix, list(product(*spans)), constant, unwrap=False,
+            chunksize=16, progress='Mass matrix',
+        )
     else:
-        ret = [element_mass_matrix(span, *constant) for span in product(*spans)]
+        ret = (element_mass_matrix(span, *constant) for span in product(*spans))
 
-    return tuple(
-        np.array(list(chain.from_iterable(r[i] for r in ret)))
-        for i in range(3)
-    )
+    # Convert the results to arrays as they come in
+    data, rows, cols = [], [], []
+    for d, r, c in ret:
+        data.append(d)
+        rows.append(np.array(r))
+        cols.append(np.array(c))
+    return tuple(np.hstack(a) for a in (data, rows, cols))
@@ -0,0 +1,85 @@
+import numpy as np
+import os
+import tempfile
+
+
+class SnapshotStore:
+    """A matrix of snapshot coefficient vectors (one per row), backed by a
+    memory-mapped temporary file rather than by RAM.
+
+    The intended use is to fill the store once, row by row, and then stream
+    through it in blocks of rows, so that only the blocks being worked on
+    need to be in memory.
+
+    When pickled, only the file name and shape are sent, so that worker
+    processes can map the same file and read (or write) rows directly.
+    """
+
+    def __init__(self, nsnaps, ndofs, path=None, dtype=float):
+        """Create a store for `nsnaps` snapshots of size `ndofs`.
+
+        The backing file is created in the directory `path` (by default, the
+        system temporary directory), and removed when the store is closed.
+        """
+        fd, self.filename = tempfile.mkstemp(prefix='ramos-', suffix='.snapshots', dir=path)
+        os.close(fd)
+        self.shape = (nsnaps, ndofs)
+        self.dtype = np.dtype(dtype)
+        self.owner = True
+        self.data = np.memmap(self.filename, dtype=self.dtype, mode='w+', shape=self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=self.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, backtrace):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+    @property
+    def nsnaps(self):
+        return self.shape[0]
+
+    @property
+    def ndofs(self):
+        return self.shape[1]
+
+    def block_size(self, maxbytes):
+        """Number of rows that fit in a block of at most `maxbytes` bytes."""
+        return max(1, maxbytes // (self.ndofs * self.dtype.itemsize))
+
+    def blocks(self, size):
+        """Iterate over tuples (start, block) of at most `size` rows at a time."""
+        for start in range(0, self.nsnaps, size):
+            yield start, self.data[start:start+size]
+
+    def flush(self):
+        """Make sure all changes are written to the backing file."""
+        self.data.flush()
+
+    def close(self):
+        """Release the memory map, and remove the backing file if this is the
+        original store (rather than a copy in a worker process).
+        """
+        if self.data is None:
+            return
+        self.data = None
+        if self.owner:
+            os.remove(self.filename)
@@ -1,6 +1,29 @@
 import numpy as np
 
 
+def field_slices(fields):
+    """Iterate over pairs of (field, slice), where the slice gives the location of
+    that field's coefficients in a concatenated coefficient vector.
+    """
+    glob_index = 0
+    for field in fields:
+        n = field.size * field.ncomps
+        yield field, slice(glob_index, glob_index + n)
+        glob_index += n
+
+
+def allocate(fields, out=None):
+    """Return an uninitialized concatenated coefficient vector for the given
+    fields, or check that `out` is suitable as one.
+    """
+    size = sum(field.size * field.ncomps for field in fields)
+    if out is None:
+        return np.empty((size,))
+    if out.shape != (size,):
+        raise ValueError('Expected output array of shape ({},)'.format(size))
+    return out
+
+
 def decompose(fields, coeffs):
     ret = []
     glob_index = 0
@@ -1,12 +1,14 @@
-from itertools import product, repeat, chain
+import hashlib
+from itertools import product, chain
 import logging
 import numpy as np
 import quadpy
 import vtk
-from vtk.util.numpy_support import vtk_to_numpy
+from scipy.sparse import csr_matrix
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
-from ramos.utils.parallel import parmap
-from ramos.utils.quadrature import triangular
+from ramos.utils.parallel import parimap
+from ramos.utils.quadrature import triangular, tetrahedral
 
 
 def get_cells(dataset):
@@ -18,21 +20,89 @@ def get_cells(dataset):
         raise TypeError('Unknown dataset type')
 
 
-def get_cell_indices(dataset):
-    # cell_indices: each row contains the point indices for that cell,
-    # possibly filled with -1 on the end for variable cell sizes
+def get_cell_types(dataset):
+    """Return the VTK cell type of each cell of an unstructured grid."""
+    # VTK 9.6 deprecated GetCellTypesArray in favour of GetCellTypes, which
+    # had a different meaning in earlier versions
+    version = (vtk.vtkVersion.GetVTKMajorVersion(), vtk.vtkVersion.GetVTKMinorVersion())
+    if version >= (9, 6):
+        return vtk_to_numpy(dataset.GetCellTypes())
+    return vtk_to_numpy(dataset.GetCellTypesArray())
+
+
+def get_cell_arrays(dataset):
+    """Return the cells of a dataset in compressed form, as a tuple of arrays
+    (offsets, connectivity), so that the point indices of cell i are
+    connectivity[offsets[i]:offsets[i+1]].
+
+    This is done without looping over the cells in Python, also for the legacy
+    cell storage of VTK 8 and earlier (see split_legacy_cells).
+    """
     cells = get_cells(dataset)
-    ncells = cells.GetNumberOfCells()
-    cellsize = cells.GetMaxCellSize()
-    cell_indices = np.empty((ncells, cellsize), dtype=np.int)
+
+    # VTK 9 and later store the cells in this form natively
+    if hasattr(cells, 'GetOffsetsArray'):
+        offsets = vtk_to_numpy(cells.GetOffsetsArray()).astype(int)
+        connectivity = vtk_to_numpy(cells.GetConnectivityArray()).astype(int)
+        return offsets, connectivity
+
+    # Otherwise (VTK 8 and earlier), the cells are stored in the legacy form
+    cell_raw = vtk_to_numpy(cells.GetData()).astype(int)
+    return split_legacy_cells(cell_raw, cells.GetNumberOfCells())
+
+
+def split_legacy_cells(cell_raw, ncells):
+    """Convert cells stored in the legacy VTK form, where the number of points
+    precedes the point indices of each cell, to a tuple of arrays (offsets,
+    connectivity) as returned by get_cell_arrays.
+    """
+    cell_raw = np.asarray(cell_raw, dtype=int)
+    n = len(cell_raw)
+    if n == 0 or n % ncells == 0 and np.all(cell_raw[::n // ncells] == n // ncells - 1):
+        # All cells have the same size, so the positions are known
+        positions = np.arange(ncells) * (n // ncells if ncells else 0)
+    else:
+        # Variable cell sizes: the position of each cell follows from that of
+        # the previous one. Starting from every entry, jumps[j] is where the
+        # next cell would start. Doubling the length of the jumps in each
+        # round, all the cell positions are found in log2(ncells) rounds.
+        jumps = np.minimum(np.arange(n) + cell_raw + 1, n)
+        jumps = np.append(jumps, n)
+        reached = np.zeros((n + 1,), dtype=bool)
+        reached[0] = True
+        for _ in range(max(1, int(ncells).bit_length())):
+            reached[jumps[reached]] = True
+            jumps = jumps[jumps]
+        positions = np.nonzero(reached[:n])[0]
+
+    offsets = np.zeros((ncells + 1,), dtype=int)
+    np.cumsum(cell_raw[positions], out=offsets[1:])
+    connectivity = np.delete(cell_raw, positions)
+    return offsets, connectivity
+
+
+def get_cell_indices(dataset, compact=False):
+    """Return the point indices of each cell in a dataset.
+
+    The result is a matrix where each row contains the point indices for
+    that cell, possibly filled with -1 on the end for variable cell sizes.
+
+    If `compact` is true, return a tuple (cell_indices, offsets,
+    connectivity), where the last two are as returned by get_cell_arrays.
+    """
+    offsets, connectivity = get_cell_arrays(dataset)
+    sizes = np.diff(offsets)
+    ncells = len(sizes)
+    cellsize = np.max(sizes) if ncells > 0 else 0
+
+    cell_indices = np.empty((ncells, cellsize), dtype=int)
     cell_indices[:] = -1
-    cell_raw = vtk_to_numpy(cells.GetData())
-    j = 0
-    for i in range(ncells):
-        l = cell_raw[j]
-        j += 1
-        cell_indices[i,:l] = cell_raw[j:j+l]
-        j += l
+    rows = np.repeat(np.arange(ncells), sizes)
+    cols = np.arange(len(connectivity)) - np.repeat(offsets[:-1], sizes)
+    cell_indices[rows, cols] = connectivity
+
+    if compact:
+        return cell_indices, offsets, connectivity
     return cell_indices
 
 
@@ -149,24 +219,224 @@ def element_mass_matrix(indices, points, pardim):
     return result, row_inds, col_inds
 
 
-def mass_matrix(dataset, variates, parallel=True):
-    # Decompose the grid into arrays of indices and points for each cell
-    indices, points = decompose(dataset, variates)
+def element_mass_matrices(indices, points, pardim):
+    """Compute the element mass matrices for a block of cells.
 
-    # Each worker returns a tuple of: flat matrix, row indices, column indices
-    args = list(zip(indices, points, repeat(len(variates))))
-    if parallel:
-        ret = parmap(element_mass_matrix, args)
-    else:
-        ret = [element_mass_matrix(*arg) for arg in args]
-
-    # Form complete data arrays
+    Returns a tuple of arrays: flat matrices, row indices, column indices.
+    """
+    ret = [element_mass_matrix(i, p, pardim) for i, p in zip(indices, points)]
     return tuple(
         np.array(list(chain.from_iterable(r[i] for r in ret)))
         for i in range(3)
     )
 
 
+def gauss_rule(pardim):
+    """Tensor product 3-point Gauss rule on the unit square or cube."""
+    qpts, qwts = np.polynomial.legendre.leggauss(3)
+    qpts = (qpts + 1) / 2
+    qwts = qwts / 2
+    pts = np.array(list(product(qpts, repeat=pardim)))
+    wts = np.prod(list(product(qwts, repeat=pardim)), axis=1)
+    return pts, wts
+
+
+def reference_element(npts, pardim):
+    """Return quadrature weights, basis function values and basis function
+    gradients at the quadrature points for a reference element.
+
+    The arrays have shape nqp, nqp × npts and nqp × pardim × npts,
+    respectively. The basis functions are the same as those used by
+    element_mass_matrix. Returns None for unsupported element types.
+    """
+    one = lambda x: np.ones_like(x)
+
+    if npts == 4 and pardim == 2:
+        pts, wts = gauss_rule(2)
+        x, y = pts.T
+        basis = [(1-x)*(1-y), (1-x)*y, x*y, x*(1-y)]
+        grads = [
+            [y-1, -y, y, 1-y],
+            [x-1, 1-x, x, -x],
+        ]
+
+    elif npts == 3 and pardim == 2:
+        pts, wts = map(np.array, triangular(2))
+        x, y = pts.T
+        basis = [1-x-y, y, x]
+        grads = [
+            [-one(x), 0*x, one(x)],
+            [-one(x), one(x), 0*x],
+        ]
+
+    elif npts == 8 and pardim == 3:
+        pts, wts = gauss_rule(3)
+        a, b, c = pts.T
+        basis = [
+            a*(1-b)*c, a*b*c, a*b*(1-c), a*(1-b)*(1-c),
+            (1-a)*(1-b)*c, (1-a)*b*c, (1-a)*b*(1-c), (1-a)*(1-b)*(1-c),
+        ]
+        grads = [
+            [(1-b)*c, b*c, b*(1-c), (1-b)*(1-c), -(1-b)*c, -b*c, -b*(1-c), -(1-b)*(1-c)],
+            [-a*c, a*c, a*(1-c), -a*(1-c), -(1-a)*c, (1-a)*c, (1-a)*(1-c), -(1-a)*(1-c)],
+            [a*(1-b), a*b, -a*b, -a*(1-b), (1-a)*(1-b), (1-a)*b, -(1-a)*b, -(1-a)*(1-b)],
+        ]
+
+    elif npts == 4 and pardim == 3:
+        pts, wts = map(np.array, tetrahedral(2))
+        x, y, z = pts.T
+        basis = [1-x-y-z, x, y, z]
+        grads = [
+            [-one(x), one(x), 0*x, 0*x],
+            [-one(x), 0*x, one(x), 0*x],
+            [-one(x), 0*x, 0*x, one(x)],
+        ]
+
+    else:
+        return None
+
+    basis = np.array(basis).T
+    grads = np.transpose(np.array(grads), (2, 0, 1))
+    return wts, basis, grads
+
+
+def batched_mass_matrix(cell_indices, points, blocksize=65536):
+    """Compute element mass matrices for all cells using vectorized NumPy
+    operations.
+
+    - `cell_indices`: ncells × cellsize array of point indices, padded with -1
+    - `points`: npoints × pardim array of point coordinates
+    - `blocksize`: maximal number of cells to process at once (to bound
+      memory use)
+
+    Cells are grouped by type. For each type, the basis functions are
+    evaluated at the quadrature points once, and the element matrices are
+    computed for blocks of cells at a time.
+
+    Returns a tuple of: flat matrices, row indices, column indices.
+    """
+    pardim = points.shape[1]
+    npts = np.sum(cell_indices >= 0, axis=1)
+
+    data, rows, cols = [], [], []
+    for n in np.unique(npts):
+        ref = reference_element(n, pardim)
+        if ref is None:
+            continue
+        wts, basis, grads = ref
+
+        # Products of pairs of basis functions at each quadrature point,
+        # with the quadrature weights folded in: nqp × (npts*npts)
+        basis2 = np.einsum('q,qi,qj->qij', wts, basis, basis).reshape(len(wts), -1)
+
+        cells = np.where(npts == n)[0]
+        for start in range(0, len(cells), blocksize):
+            indices = cell_indices[cells[start:start+blocksize], :n]
+            cellpts = points[indices]
+
+            # Jacobian determinants at each quadrature point: ncells × nqp
+            jac = np.einsum('qdi,cie->cqde', grads, cellpts)
+            det = np.abs(np.linalg.det(jac))
+
+            data.append(np.ndarray.flatten(det.dot(basis2)))
+            rows.append(np.ndarray.flatten(np.repeat(indices, n, axis=1)))
+            cols.append(np.ndarray.flatten(np.tile(indices, (1, n))))
+
+    if not data:
+        return np.array([]), np.array([], dtype=int), np.array([], dtype=int)
+    return tuple(np.hstack(a) for a in (data, rows, cols))
+
+
+def mass_matrix(dataset, variates, parallel=True, blocksize=1024, vectorized=True):
+    """Compute the mass matrix of a VTK dataset.
+
+    Returns a tuple of: flat element matrices, row indices, column indices.
+
+    By default, all element matrices are computed in one go using
+    batched_mass_matrix. If `vectorized` is false, they are computed cell by
+    cell using element_mass_matrix, optionally in parallel with blocks of
+    `blocksize` cells at a time.
+    """
+    if vectorized:
+        cell_indices = get_cell_indices(dataset)
+        points = vtk_to_numpy(dataset.GetPoints().GetData())[:, variates]
+        logging.debug('Mesh with %d cells, max size %d', *cell_indices.shape)
+        return batched_mass_matrix(cell_indices, points)
+
+    # Decompose the grid into arrays of indices and points for each cell
+    indices, points = decompose(dataset, variates)
+    pardim = len(variates)
+
+    if not parallel:
+        return element_mass_matrices(indices, points, pardim)
+
+    # Each worker returns arrays for a block of cells. The cost per cell varies
+    # with the cell type, so the blocks are handed out dynamically, and the
+    # results are collected as they come in.
+    args = [
+        (indices[i:i+blocksize], points[i:i+blocksize])
+        for i in range(0, len(indices), blocksize)
+    ]
+    results = parimap(element_mass_matrices, args, (pardim,), progress='Mass matrix')
+
+    # Each cell contributes at most npts × npts entries, so the complete data
+    # arrays can be allocated up front and filled as the results come in,
+    # without holding on to the results of all the blocks
+    nentries = np.sum(np.sum(indices >= 0, axis=1) ** 2)
+    data = np.empty((nentries,))
+    rows = np.empty((nentries,), dtype=int)
+    cols = np.empty((nentries,), dtype=int)
+    pos = 0
+    for block_data, block_rows, block_cols in results:
+        n = len(block_data)
+        data[pos:pos+n] = block_data
+        rows[pos:pos+n] = block_rows
+        cols[pos:pos+n] = block_cols
+        pos += n
+
+    # Unsupported cells contribute nothing
+    return data[:pos], rows[:pos], cols[:pos]
+
+
+def read_dataset(filename):
+    """Read a dataset from a legacy VTK file."""
+    reader = vtk.vtkDataSetReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def dataset_size(dataset):
+    """Approximate memory used by a dataset, in bytes."""
+    return dataset.GetActualMemorySize() * 1024
+
+
+def mesh_hash(dataset, *extra):
+    """Return a hash of the points and cells of a dataset, and optionally of
+    additional arrays (such as the variates).
+    """
+    arrays = [vtk_to_numpy(dataset.GetPoints().GetData()), *get_cell_arrays(dataset)]
+    if isinstance(dataset, vtk.vtkUnstructuredGrid):
+        arrays.append(get_cell_types(dataset))
+    arrays.extend(np.asarray(e) for e in extra)
+
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update('{}{}'.format(array.dtype.str, array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def shallow_copy(dataset):
+    """Return a new dataset sharing the arrays of `dataset`. Arrays can be
+    added to or removed from the copy without affecting the original.
+    """
+    copy = dataset.NewInstance()
+    copy.ShallowCopy(dataset)
+    return copy
+
+
 def write_to_file(dataset, filename):
     if isinstance(dataset, vtk.vtkPolyData):
         writer = vtk.vtkPolyDataWriter()
@@ -177,3 +447,186 @@ def write_to_file(dataset, filename):
     writer.SetFileName(filename)
     writer.SetInputData(dataset)
     writer.Write()
+
+
+def interpolation_matrix(dataset, points):
+    """Compute the matrices that interpolate point data and cell data on a
+    dataset to a set of points.
+
+    Returns a tuple (W, C, found). W is a sparse matrix, so that W × u are the
+    values at the given points of the point data u. C is a sparse matrix
+    which picks, for each point, the value of the cell data in the cell
+    containing it. `found` is a boolean mask of the points that were found
+    in the dataset. The rows of W and C corresponding to points that were
+    not found are zero.
+
+    The cells are located by a probe filter, so that the result agrees with
+    its output, including for points slightly outside the dataset (such as
+    near curved boundaries) that are accepted within its tolerance.
+    """
+    npoints, ncells = len(points), dataset.GetNumberOfCells()
+
+    # Probe the cell indices, which the probe filter copies from the cell
+    # containing each point
+    source = dataset.NewInstance()
+    source.CopyStructure(dataset)
+    cellids = numpy_to_vtk(np.arange(ncells, dtype=np.int64), deep=1)
+    cellids.SetName('cellids')
+    source.GetCellData().AddArray(cellids)
+
+    probe_points = vtk.vtkPoints()
+    probe_points.SetData(numpy_to_vtk(np.ascontiguousarray(points, dtype=float), deep=1))
+    probe_input = vtk.vtkPolyData()
+    probe_input.SetPoints(probe_points)
+
+    probefilter = vtk.vtkProbeFilter()
+    probefilter.SetInputData(probe_input)
+    probefilter.SetSourceData(source)
+    probefilter.Update()
+    pointdata = probefilter.GetOutput().GetPointData()
+    found = vtk_to_numpy(pointdata.GetArray('vtkValidPointMask')).astype(bool)
+    cells = vtk_to_numpy(pointdata.GetArray('cellids'))[found]
+    indices = np.nonzero(found)[0]
+
+    # The weights are those of the containing cell at each point, as
+    # computed by the probe filter. This is inherently serial, but it's done
+    # only once for each mesh.
+    cell = vtk.vtkGenericCell()
+    closest, pcoords = [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+    subid, dist2 = vtk.reference(0), vtk.reference(0.0)
+    weights = [0.0] * dataset.GetMaxCellSize()
+    rows, cols, data = [], [], []
+    for i, cellid in zip(indices, cells):
+        dataset.GetCell(int(cellid), cell)
+        cell.EvaluatePosition(points[i], closest, subid, pcoords, dist2, weights)
+        ids = cell.GetPointIds()
+        npts = ids.GetNumberOfIds()
+        rows.append(np.full((npts,), i))
+        cols.append([ids.GetId(j) for j in range(npts)])
+        data.append(weights[:npts])
+
+    shape = (npoints, dataset.GetNumberOfPoints())
+    if rows:
+        rows, cols, data = (np.hstack(a) for a in (rows, cols, data))
+        pointmx = csr_matrix((data, (rows, cols)), shape=shape)
+    else:
+        pointmx = csr_matrix(shape)
+    cellmx = csr_matrix(
+        (np.ones((len(indices),)), (indices, cells)), shape=(npoints, ncells)
+    )
+    return pointmx, cellmx, found
+
+
+class Prober:
+    """Interpolates datasets onto the points of a target mesh.
+
+    The probe filter is created lazily, once per process, so a prober can be
+    pickled and sent to worker processes along with the target source.
+
+    Optionally, the prober computes a sparse interpolation matrix from the
+    mesh of a dataset to the target points, and reuses it for as long as
+    consecutive datasets have the same mesh (as determined by mesh_hash).
+    Interpolating a dataset is then a sparse product for each point or cell
+    data array, rather than a search for the cell containing each point.
+    """
+
+    def __init__(self, target, reuse_weights=False):
+        """Create a prober for the mesh of the first dataset of `target`. If
+        `reuse_weights` is true, use interpolation matrices.
+        """
+        self.target = target
+        self.reuse_weights = reuse_weights
+        self._filter = None
+        self._weights = None        # Tuple (hash, point matrix, cell matrix, mask)
+
+    def __getstate__(self):
+        # The interpolation matrix is kept, so that it can be computed once
+        # and sent to worker processes
+        state = self.__dict__.copy()
+        state['_filter'] = None
+        return state
+
+    def target_dataset(self):
+        """Return the dataset whose points are interpolated to."""
+        index = next(self.target.dataset_indices())
+        return self.target.dataset(*index)
+
+    def filter(self):
+        """Return the probe filter, creating it if necessary."""
+        if self._filter is None:
+            self._filter = vtk.vtkProbeFilter()
+            self._filter.SetInputData(self.target_dataset())
+        return self._filter
+
+    def weights(self, dataset):
+        """Return the interpolation matrices for point and cell data, and the
+        mask of found points, for a dataset (see interpolation_matrix). They
+        are recomputed only if the mesh has changed.
+        """
+        key = mesh_hash(dataset)
+        if self._weights is None or self._weights[0] != key:
+            logging.debug('Computing interpolation weights')
+            points = vtk_to_numpy(self.target_dataset().GetPoints().GetData())
+            self._weights = (key, *interpolation_matrix(dataset, points))
+        return self._weights[1:]
+
+    def __call__(self, dataset):
+        """Interpolate a dataset. The output may be owned by the prober, in which
+        case it is only valid until the next call.
+        """
+        if self.reuse_weights:
+            return self.interpolate(dataset)
+
+        probefilter = self.filter()
+        probefilter.SetSourceData(dataset)
+        probefilter.Update()
+        output = probefilter.GetUnstructuredGridOutput()
+        if not output:
+            output = probefilter.GetPolyDataOutput()
+        if not output:
+            raise TypeError('Unsupported dataset type')
+        return output
+
+    def interpolate(self, dataset):
+        """Interpolate a dataset using the interpolation matrix. The output has
+        the same arrays as that of the probe filter.
+        """
+        pointmx, cellmx, found = self.weights(dataset)
+        output = shallow_copy(self.target_dataset())
+        output.GetCellData().Initialize()
+        pointdata = output.GetPointData()
+        pointdata.Initialize()
+
+        # Like the probe filter, the cell data of the source become point
+        # data, following the point data
+        sources = [
+            (dataset.GetPointData(), pointmx, dataset.GetNumberOfPoints()),
+            (dataset.GetCellData(), cellmx, dataset.GetNumberOfCells()),
+        ]
+        for source, mx, size in sources:
+            for i in range(source.GetNumberOfArrays()):
+                array = source.GetArray(i)
+                if array is None:
+                    continue
+                values = vtk_to_numpy(array).reshape((size, -1))
+                result = mx.dot(values)
+                if np.issubdtype(values.dtype, np.integer):
+                    result = np.rint(result)
+                result = result.astype(values.dtype)
+                if array.GetNumberOfComponents() == 1:
+                    result = result.ravel()
+                array = numpy_to_vtk(result, deep=1)
+                array.SetName(source.GetArrayName(i))
+                pointdata.AddArray(array)
+
+        mask = numpy_to_vtk(found.astype(np.int8), deep=1, array_type=vtk.VTK_CHAR)
+        mask.SetName('vtkValidPointMask')
+        pointdata.AddArray(mask)
+        return output
+
+
+def probe_to_file(index, filename, source, prober):
+    """Interpolate a dataset from a source with a prober, and write the result to
+    a file. Suitable as a parallel worker function.
+    """
+    write_to_file(prober(source.dataset(*index)), filename)